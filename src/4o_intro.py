@@ -3,8 +3,6 @@
 from openai import OpenAI
 from helpers import print_spacer
 
-import os
-
 ## Set the API key and model name
 MODEL="gpt-4o"
 client = OpenAI() # defaults to getting the API key using os.environ.get("OPENAI_API_KEY")
@@ -73,41 +71,46 @@ client = OpenAI() # defaults to getting the API key using os.environ.get("OPENAI
 # print(response.choices[0].message.content)
 
 #### VIDEO
-import cv2
-from moviepy.editor import VideoFileClip
 import time
-import base64
+from video import FrameFilter, preprocess_video
 
 # We'll be using the OpenAI DevDay Keynote Recap video. You can review the video here: https://www.youtube.com/watch?v=h02ti0Bl6zk
 VIDEO_PATH = "../data/keynote_recap.mp4" # can't download the video
 
-def process_video(video_path, seconds_per_frame=2):
-    base64Frames = []
-    base_video_path, _ = os.path.splitext(video_path)
-
-    video = cv2.VideoCapture(video_path)
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = video.get(cv2.CAP_PROP_FPS)
-    frames_to_skip = int(fps * seconds_per_frame)
-    curr_frame=0
-
-    # Loop through the video and extract frames at specified sampling rate
-    while curr_frame < total_frames - 1:
-        video.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
-        success, frame = video.read()
-        if not success:
-            break
-        _, buffer = cv2.imencode(".jpg", frame)
-        base64Frames.append(base64.b64encode(buffer).decode("utf-8"))
-        curr_frame += frames_to_skip
-    video.release()
-
-    # Extract audio from video
-    audio_path = f"{base_video_path}.mp3"
-    clip = VideoFileClip(video_path)
-    clip.audio.write_audiofile(audio_path, bitrate="32k")
-    clip.audio.close()
-    clip.close()
+def process_video(
+    video_path,
+    seconds_per_frame=2,
+    max_width=None,
+    quality=None,
+    processes=None,
+    dedup=None,
+    min_seconds_per_frame=None,
+    cache_dir=None,
+):
+    """Return the sampled frames as base64 JPEGs, and the path of the extracted audio.
+
+    Frames are decoded in one forward pass (see video.py) while ffmpeg extracts
+    the audio; max_width and quality shrink them, and processes decodes a long
+    video in parallel segments. dedup ("dhash", "diff" or None) drops
+    near-duplicate frames, and min_seconds_per_frame samples more densely around
+    scene changes. With cache_dir (e.g. "../data/video_cache"), results are cached there.
+    """
+    frame_filter = FrameFilter(dedup) if dedup else None
+
+    # Sample frames and extract the audio at the same time, or read both from the cache
+    frames, audio_path = preprocess_video(
+        video_path,
+        seconds_per_frame,
+        max_width=max_width,
+        quality=quality,
+        processes=processes,
+        dedup=frame_filter,
+        min_seconds_per_frame=min_seconds_per_frame,
+        cache_dir=cache_dir,
+    )
+    base64Frames = [frame.data for frame in frames]
+    if frame_filter is not None and frame_filter.kept:
+        print(f"Dropped {frame_filter.dropped} near-duplicate frames")
 
     print(f"Extracted {len(base64Frames)} frames")
     print(f"Extracted audio to {audio_path}")
@@ -0,0 +1,250 @@
+# type: ignore
+
+"""Approximate nearest-neighbor search with an inverted-file (IVF) index.
+
+A k-means coarse quantizer splits the corpus into n_lists clusters; a query
+is only scored against the rows in the n_probe clusters whose centroids are
+closest to it. More probes means higher recall and higher latency.
+
+  python -m src.ann build data/oscars_store --n-lists 256
+  python -m src.ann eval data/oscars_store --n-probe 1 4 16 64
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from src.embed_index import EmbeddingIndex, normalize_rows, top_k
+
+CENTROIDS_FILE = "ivf_centroids.npy"
+ORDER_FILE = "ivf_order.npy"
+OFFSETS_FILE = "ivf_offsets.npy"
+
+
+def _nearest_centroids(matrix: np.ndarray, centroids: np.ndarray, chunk_size: int = 65_536) -> np.ndarray:
+  """Return the index of the most similar centroid for every row, a chunk of rows at a time."""
+  labels = np.empty(matrix.shape[0], dtype=np.int32)
+  for start in range(0, matrix.shape[0], chunk_size):
+    labels[start:start + chunk_size] = np.argmax(matrix[start:start + chunk_size] @ centroids.T, axis=1)
+  return labels
+
+
+def spherical_kmeans(
+  matrix: np.ndarray,
+  n_clusters: int,
+  n_iter: int = 20,
+  seed: int = 0,
+) -> np.ndarray:
+  """Return n_clusters unit-length centroids for unit-length rows, maximizing cosine similarity."""
+  rng = np.random.default_rng(seed)
+  centroids = np.array(matrix[rng.choice(matrix.shape[0], n_clusters, replace=False)])
+  for _ in range(n_iter):
+    labels = _nearest_centroids(matrix, centroids)
+    counts = np.bincount(labels, minlength=n_clusters)
+    empty = counts == 0
+    sums = np.zeros_like(centroids)
+    order = np.argsort(labels, kind="stable")
+    starts = np.cumsum(counts) - counts
+    sums[~empty] = np.add.reduceat(matrix[order], starts[~empty])
+    if empty.any():
+      # re-seed empty clusters with random rows so every list gets used
+      sums[empty] = matrix[rng.choice(matrix.shape[0], int(empty.sum()), replace=False)]
+    centroids, _ = normalize_rows(sums)
+  return centroids
+
+
+class IVFIndex:
+  """Inverted-file index over an EmbeddingIndex, searchable like the index itself.
+
+  Row ids of list i are order[offsets[i]:offsets[i + 1]]. texts, token counts and
+  the exact index stay shared with the wrapped EmbeddingIndex.
+  """
+
+  def __init__(
+    self,
+    index: EmbeddingIndex,
+    centroids: np.ndarray,
+    order: np.ndarray,
+    offsets: np.ndarray,
+    n_probe: int = 8,
+  ):
+    self.index = index
+    self.centroids = centroids
+    self.order = order
+    self.offsets = offsets
+    self.n_probe = n_probe
+
+  @classmethod
+  def build(
+    cls,
+    index: EmbeddingIndex,
+    n_lists: int | None = None,
+    n_iter: int = 20,
+    sample_size: int = 32_768,
+    n_probe: int = 8,
+    seed: int = 0,
+  ) -> "IVFIndex":
+    """Cluster the index into n_lists inverted lists (default about 4 * sqrt(len(index))).
+
+    Centroids are trained on a random sample of up to sample_size rows, then every row is assigned.
+    """
+    n = len(index)
+    if n_lists is None:
+      n_lists = max(1, int(4 * np.sqrt(n)))
+    n_lists = min(n_lists, n)
+    rng = np.random.default_rng(seed)
+    sample = index.matrix
+    if n > sample_size:
+      sample = index.matrix[np.sort(rng.choice(n, sample_size, replace=False))]
+    centroids = spherical_kmeans(np.asarray(sample), n_lists, n_iter=n_iter, seed=seed)
+    labels = _nearest_centroids(index.matrix, centroids)
+    order = np.argsort(labels, kind="stable").astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+    return cls(index, centroids, order, offsets, n_probe=n_probe)
+
+  @property
+  def texts(self):
+    return self.index.texts
+
+  @property
+  def token_counts(self):
+    return self.index.token_counts
+
+  @property
+  def token_model(self):
+    return self.index.token_model
+
+  def __len__(self) -> int:
+    return len(self.index)
+
+  @property
+  def dim(self) -> int:
+    return self.index.dim
+
+  def search(
+    self,
+    query_embedding,
+    top_n: int = 100,
+    relatedness_fn=None,
+    n_probe: int | None = None,
+    candidates: np.ndarray | None = None,
+    first_stage_dims: int | None = None,
+    shortlist_size: int | None = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return (row ids, cosine similarities) of the top_n rows among the n_probe nearest lists.
+
+    A custom relatedness_fn can't use the cosine clustering, an explicit set
+    of candidates is already small, and first_stage_dims asks for a two-stage
+    scan of every row, so all three fall back to the wrapped index's search.
+    """
+    if relatedness_fn is not None or candidates is not None or first_stage_dims is not None:
+      return self.index.search(
+        query_embedding,
+        top_n=top_n,
+        relatedness_fn=relatedness_fn,
+        candidates=candidates,
+        first_stage_dims=first_stage_dims,
+        shortlist_size=shortlist_size,
+      )
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+    if query_embedding.shape[0] != self.dim:
+      raise ValueError(
+        f"Query embedding has dimension {query_embedding.shape[0]}, index has {self.dim}."
+      )
+    query_norm = np.linalg.norm(query_embedding)
+    if query_norm == 0 or len(self) == 0:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    query_embedding = query_embedding / query_norm
+    probes = top_k(self.centroids @ query_embedding, n_probe or self.n_probe)
+    candidates = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes])
+    candidates.sort()
+    # ^sorted ids read the memory-mapped matrix front to back
+    scores = self.index.matrix[candidates] @ query_embedding
+    best = top_k(scores, top_n)
+    return candidates[best], scores[best]
+
+  def save(self, path: str) -> None:
+    """Write the coarse quantizer and inverted lists into a store directory."""
+    np.save(os.path.join(path, CENTROIDS_FILE), self.centroids)
+    np.save(os.path.join(path, ORDER_FILE), self.order)
+    np.save(os.path.join(path, OFFSETS_FILE), self.offsets)
+
+  @classmethod
+  def load(cls, path: str, index: EmbeddingIndex | None = None, n_probe: int = 8) -> "IVFIndex":
+    """Open an IVF index saved into a store directory, memory-mapping its inverted lists."""
+    if index is None:
+      from src.embed_store import load_index
+
+      index = load_index(path)
+    order = np.load(os.path.join(path, ORDER_FILE), mmap_mode="r")
+    if len(order) != len(index):
+      # ^order lists every indexed row once, so its length is the row count the lists were built for
+      raise ValueError(
+        f"The IVF index in {path} covers {len(order)} rows but the store has {len(index)}; "
+        f"rebuild it with python -m src.ann build {path}."
+      )
+    return cls(
+      index,
+      np.load(os.path.join(path, CENTROIDS_FILE)),
+      order,
+      np.load(os.path.join(path, OFFSETS_FILE)),
+      n_probe=n_probe,
+    )
+
+
+def recall_at_k(exact, approximate, queries: np.ndarray, k: int = 10) -> float:
+  """Return the mean fraction of exact top-k ids that the approximate search also returns."""
+  found = 0
+  for query in queries:
+    expected, _ = exact.search(query, top_n=k)
+    got, _ = approximate.search(query, top_n=k)
+    found += len(np.intersect1d(expected, got))
+  return found / (k * len(queries))
+
+
+def _evaluate(path: str, n_probes: list[int], k: int, n_queries: int, seed: int) -> None:
+  """Print recall@k and mean latency per n_probe, using stored rows (plus noise) as queries."""
+  index = IVFIndex.load(path)
+  rng = np.random.default_rng(seed)
+  queries = np.asarray(index.index.matrix[rng.choice(len(index), n_queries, replace=False)])
+  queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+  # ^perturbed so a query is not trivially its own nearest neighbor
+  start = time.perf_counter()
+  for query in queries:
+    index.index.search(query, top_n=k)
+  exact_ms = (time.perf_counter() - start) / n_queries * 1000
+  print(f"exact: {exact_ms:.2f} ms/query")
+  for n_probe in n_probes:
+    index.n_probe = n_probe
+    start = time.perf_counter()
+    for query in queries:
+      index.search(query, top_n=k)
+    ms = (time.perf_counter() - start) / n_queries * 1000
+    recall = recall_at_k(index.index, index, queries, k=k)
+    print(f"n_probe={n_probe}: recall@{k}={recall:.3f}, {ms:.2f} ms/query")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Build or evaluate an IVF index for an embedding store.")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  build = subparsers.add_parser("build", help="train the coarse quantizer and write the inverted lists")
+  build.add_argument("store_path")
+  build.add_argument("--n-lists", type=int, default=None)
+  build.add_argument("--n-iter", type=int, default=20)
+  evaluate = subparsers.add_parser("eval", help="compare recall@k and latency against exact search")
+  evaluate.add_argument("store_path")
+  evaluate.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 16, 64])
+  evaluate.add_argument("--k", type=int, default=10)
+  evaluate.add_argument("--queries", type=int, default=200)
+  evaluate.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  if args.command == "build":
+    from src.embed_store import load_index
+
+    ivf = IVFIndex.build(load_index(args.store_path), n_lists=args.n_lists, n_iter=args.n_iter)
+    ivf.save(args.store_path)
+    print(f"Wrote {len(ivf.offsets) - 1} inverted lists to {args.store_path}.")
+  else:
+    _evaluate(args.store_path, args.n_probe, args.k, args.queries, args.seed)
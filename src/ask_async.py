@@ -0,0 +1,154 @@
+# type: ignore
+
+import asyncio
+import os
+from typing import AsyncIterator
+
+import numpy as np
+from openai import AsyncOpenAI
+
+import src.embed_helpers as eh
+from src.cache import AnswerCache, QueryEmbeddingCache
+from src.embed_index import EmbeddingIndex
+
+
+class AnswerEventHandler:
+  """Receives an answer while it streams in. Override the hooks you need.
+
+  Mirrors the AssistantEventHandler used in main.py, for chat completions.
+  """
+
+  def on_text_created(self) -> None:
+    pass
+
+  def on_text_delta(self, delta: str, snapshot: str) -> None:
+    pass
+
+  def on_text_done(self, text: str) -> None:
+    pass
+
+
+class PrintEventHandler(AnswerEventHandler):
+  """Prints the answer to the terminal as it arrives."""
+
+  def on_text_created(self) -> None:
+    print(f"\nassistant > ", end="", flush=True)
+
+  def on_text_delta(self, delta: str, snapshot: str) -> None:
+    print(delta, end="", flush=True)
+
+  def on_text_done(self, text: str) -> None:
+    print(flush=True)
+
+
+async def query_embedding_async(
+  query: str,
+  client: AsyncOpenAI,
+  embedding_cache: QueryEmbeddingCache | None = None,
+):
+  """Return the embedding of a query, from embedding_cache when it has been asked before."""
+  if embedding_cache is not None:
+    embedding = await asyncio.to_thread(embedding_cache.lookup, eh.EMBEDDING_MODEL, query)
+    # ^SQLite reads and writes run off the event loop, like the index search
+    if embedding is not None:
+      return embedding
+  response = await client.embeddings.create(model=eh.EMBEDDING_MODEL, input=query)
+  embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+  if embedding_cache is not None:
+    await asyncio.to_thread(embedding_cache.store, eh.EMBEDDING_MODEL, query, embedding)
+  return embedding
+
+
+async def stream_answer(
+  query: str,
+  index: EmbeddingIndex,
+  client: AsyncOpenAI,
+  model: str = eh.GPT_MODEL,
+  token_budget: int = 4096 - 500,
+  skip_oversized: bool = False,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  event_handler: AnswerEventHandler | None = None,
+  answer_cache: AnswerCache | None = None,
+) -> AsyncIterator[str]:
+  """Yield the answer to a query piece by piece, as the chat completion streams in.
+
+  The search and prompt building run in a worker thread, so many questions can
+  share one event loop without blocking each other. An answer found in
+  answer_cache is yielded whole, without calling GPT.
+  """
+  event_handler = event_handler or AnswerEventHandler()
+  embedding = await query_embedding_async(query, client, embedding_cache=embedding_cache)
+  ids, _ = await asyncio.to_thread(index.search, embedding)
+  message = await asyncio.to_thread(
+    eh.message_from_ids, query, index, ids, model, token_budget, skip_oversized
+  )
+  messages = eh.chat_messages(message)
+  if answer_cache is not None:
+    answer = await asyncio.to_thread(answer_cache.lookup, model, messages)
+    if answer is not None:
+      event_handler.on_text_created()
+      event_handler.on_text_delta(answer, answer)
+      yield answer
+      event_handler.on_text_done(answer)
+      return
+  stream = await client.chat.completions.create(
+    model=model,
+    messages=messages,
+    temperature=0,
+    stream=True,
+  )
+  event_handler.on_text_created()
+  snapshot = ""
+  async for chunk in stream:
+    if not chunk.choices:
+      continue
+    delta = chunk.choices[0].delta.content
+    if delta:
+      snapshot += delta
+      event_handler.on_text_delta(delta, snapshot)
+      yield delta
+  if answer_cache is not None:
+    await asyncio.to_thread(answer_cache.store, model, messages, snapshot)
+  event_handler.on_text_done(snapshot)
+
+
+async def ask_async(
+  query: str,
+  index: EmbeddingIndex,
+  client: AsyncOpenAI,
+  **kwargs,
+) -> str:
+  """Answers a query like embed_helpers.ask, without blocking the event loop. See stream_answer for options."""
+  return "".join([delta async for delta in stream_answer(query, index, client, **kwargs)])
+
+
+async def ask_many_async(
+  queries: list[str],
+  index: EmbeddingIndex,
+  client: AsyncOpenAI,
+  max_concurrency: int = 8,
+  **kwargs,
+) -> list[str]:
+  """Answers many queries on one event loop, at most max_concurrency at a time, in input order."""
+  semaphore = asyncio.Semaphore(max_concurrency)
+
+  async def bounded(query: str) -> str:
+    async with semaphore:
+      return await ask_async(query, index, client, **kwargs)
+
+  return await asyncio.gather(*(bounded(q) for q in queries))
+
+
+if __name__ == "__main__":
+  from src import embed_store
+
+  index = embed_store.load_index("data/oscars_store")
+  client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+  async def main():
+    async for _ in stream_answer(
+      "Who won for best lead at the 2024 Oscars?", index, client, event_handler=PrintEventHandler()
+    ):
+      pass
+
+  asyncio.run(main())
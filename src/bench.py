@@ -0,0 +1,347 @@
+# type: ignore
+
+"""Benchmarks for chunking, token counting, retrieval and prompt building, on synthetic data.
+
+  python -m src.bench --out bench.json
+  python -m src.bench --sizes 1000 10000 --out new.json --baseline bench.json
+  python -m src.bench --only imports  # startup cost of the query and ingestion modules
+
+Text and embeddings come from a seeded RNG and queries are embedded by
+SyntheticClient, so no API calls are made and runs are comparable between
+versions. Token counting still needs tiktoken's encoding files, which are
+downloaded once and cached (see TIKTOKEN_CACHE_DIR). Corpora are written as
+embedding stores under --work-dir and reused by later runs; the 1M-chunk
+corpus at dimension 1536 takes about 6.5 GB.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+
+import src.embed_helpers as eh
+from src import embed_store, ingest
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+BENCHMARKS = ("split", "num_tokens", "corpus", "imports")
+IMPORT_MODULES = ("src.embed_helpers", "src.serve", "src.ingest")
+
+
+class SyntheticClient:
+  """Stands in for openai.OpenAI: embeddings are random vectors seeded by the input text."""
+
+  def __init__(self, dim: int, seed: int = 0):
+    self.dim = dim
+    self.seed = seed
+    self.embeddings = SimpleNamespace(create=self._create_embeddings)
+
+  def embed(self, text: str) -> list[float]:
+    rng = np.random.default_rng([self.seed, zlib.crc32(text.encode("utf-8"))])
+    return rng.standard_normal(self.dim, dtype=np.float32).tolist()
+
+  def _create_embeddings(self, model: str, input):
+    inputs = [input] if isinstance(input, str) else input
+    data = [SimpleNamespace(index=i, embedding=self.embed(text)) for i, text in enumerate(inputs)]
+    return SimpleNamespace(data=data)
+
+
+def vocabulary(rng: np.random.Generator, size: int = 20_000) -> np.ndarray:
+  """Return size random lowercase words of 2 to 10 letters."""
+  letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+  lengths = rng.integers(2, 11, size=size)
+  return np.array(["".join(rng.choice(letters, n)) for n in lengths])
+
+
+def synthetic_paragraph(
+  rng: np.random.Generator,
+  vocab: np.ndarray,
+  n_sentences: int = 5,
+  sentence_words: int = 14,
+) -> str:
+  words = vocab[rng.integers(len(vocab), size=(n_sentences, sentence_words))]
+  return " ".join(" ".join(sentence).capitalize() + "." for sentence in words)
+
+
+def synthetic_sections(rng: np.random.Generator, vocab: np.ndarray, n: int) -> list[tuple[list[str], str]]:
+  """Return n (titles, text) subsections of 1 to 40 paragraphs, so some need splitting."""
+  sections = []
+  for i in range(n):
+    paragraphs = [synthetic_paragraph(rng, vocab) for _ in range(rng.integers(1, 41))]
+    sections.append(([f"Article {i}", f"Section {i}"], "\n\n".join(paragraphs)))
+  return sections
+
+
+def latency(seconds: list[float]) -> dict:
+  """Return summary statistics, in milliseconds, of a list of timings in seconds."""
+  ms = np.asarray(seconds) * 1000
+  return {
+    "mean_ms": float(ms.mean()),
+    "p50_ms": float(np.percentile(ms, 50)),
+    "p95_ms": float(np.percentile(ms, 95)),
+    "min_ms": float(ms.min()),
+  }
+
+
+def bench_split(
+  rng: np.random.Generator,
+  vocab: np.ndarray,
+  model: str,
+  n_sections: int = 200,
+  max_tokens: int = 1000,
+) -> dict:
+  """Time split_strings_from_subsection over synthetic subsections."""
+  sections = synthetic_sections(rng, vocab, n_sections)
+  eh.num_tokens("warm up", model=model)
+  # ^loads the encoding outside the timed loop
+  start = time.perf_counter()
+  chunks = []
+  for section in sections:
+    chunks.extend(ingest.split_strings_from_subsection(section, max_tokens=max_tokens, model=model))
+  seconds = time.perf_counter() - start
+  megabytes = sum(len(text.encode("utf-8")) for _, text in sections) / 2**20
+  return {
+    "sections": n_sections,
+    "chunks": len(chunks),
+    "seconds": seconds,
+    "sections_per_s": n_sections / seconds,
+    "chunks_per_s": len(chunks) / seconds,
+    "mb_per_s": megabytes / seconds,
+  }
+
+
+def bench_num_tokens(rng: np.random.Generator, vocab: np.ndarray, model: str, n_calls: int = 20_000) -> dict:
+  """Time num_tokens one string at a time, and num_tokens_batch over the same strings."""
+  texts = [synthetic_paragraph(rng, vocab, n_sentences=int(rng.integers(1, 6))) for _ in range(n_calls)]
+  eh.num_tokens("warm up", model=model)
+  start = time.perf_counter()
+  total = sum(eh.num_tokens(t, model=model) for t in texts)
+  seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  eh.num_tokens_batch(texts, model=model)
+  batch_seconds = time.perf_counter() - start
+  return {
+    "calls": n_calls,
+    "calls_per_s": n_calls / seconds,
+    "tokens_per_s": total / seconds,
+    "batch_texts_per_s": n_calls / batch_seconds,
+    "batch_tokens_per_s": total / batch_seconds,
+  }
+
+
+def build_corpus(
+  path: str,
+  n: int,
+  dim: int,
+  rng: np.random.Generator,
+  vocab: np.ndarray,
+  token_model: str,
+  chunk_rows: int = 65_536,
+) -> float | None:
+  """Write an n-chunk synthetic store to path and return the seconds spent, or None if one was already there."""
+  try:
+    meta = embed_store.read_meta(path)
+    if meta["count"] == n and meta["dim"] == dim and meta["token_model"] == token_model:
+      return None
+  except FileNotFoundError:
+    pass
+  start = time.perf_counter()
+  with embed_store.StoreWriter(path, model="synthetic", dim=dim, token_model=token_model) as writer:
+    for first in range(0, n, chunk_rows):
+      rows = min(chunk_rows, n - first)
+      texts = [synthetic_paragraph(rng, vocab, n_sentences=4) for _ in range(rows)]
+      writer.append(texts, rng.standard_normal((rows, dim), dtype=np.float32))
+  return time.perf_counter() - start
+
+
+def bench_corpus(
+  path: str,
+  client: SyntheticClient,
+  queries: list[str],
+  model: str,
+  token_budget: int = 4096 - 500,
+) -> dict:
+  """Time opening a store, strings_ranked_by_relatedness and query_message against it."""
+  load_seconds = []
+  for _ in range(5):
+    start = time.perf_counter()
+    index = embed_store.load_index(path)
+    load_seconds.append(time.perf_counter() - start)
+  start = time.perf_counter()
+  eh.strings_ranked_by_relatedness(queries[0], index, client)
+  first_search = time.perf_counter() - start
+  # ^the first search pages the memory-mapped embeddings in
+  search_seconds = []
+  for query in queries:
+    start = time.perf_counter()
+    eh.strings_ranked_by_relatedness(query, index, client)
+    search_seconds.append(time.perf_counter() - start)
+  message_seconds = []
+  for query in queries:
+    start = time.perf_counter()
+    eh.query_message(query, index, client, model=model, token_budget=token_budget)
+    message_seconds.append(time.perf_counter() - start)
+  return {
+    "count": len(index),
+    "dim": index.dim,
+    "load": latency(load_seconds),
+    "first_search_ms": first_search * 1000,
+    "search": latency(search_seconds),
+    "query_message": latency(message_seconds),
+  }
+
+
+def import_times(module: str) -> tuple[float, dict[str, float]]:
+  """Import module in a fresh interpreter with -X importtime.
+
+  Return its cumulative import time and that of each module it imported
+  directly, in milliseconds.
+  """
+  result = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+  )
+  total, children = 0.0, {}
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    _, cumulative, name = line.split("|")
+    if not cumulative.strip().isdigit():
+      continue
+    # ^skips the header line
+    if name.strip() == module:
+      total = int(cumulative) / 1000
+    elif name.startswith("   ") and not name.startswith("    "):
+      # ^one level below module: one space after "|", then two per level
+      children[name.strip()] = int(cumulative) / 1000
+  return total, children
+
+
+def bench_imports(modules: tuple[str, ...] = IMPORT_MODULES, repeats: int = 5, heaviest: int = 5) -> dict:
+  """Time importing each module in fresh interpreters: the import alone, the whole process, and its heaviest imports."""
+  results = {}
+  for module in modules:
+    import_ms, process_ms = [], []
+    for _ in range(repeats):
+      start = time.perf_counter()
+      total, children = import_times(module)
+      process_ms.append((time.perf_counter() - start) * 1000)
+      import_ms.append(total)
+    results[module] = {
+      "import_ms": min(import_ms),
+      "process_ms": min(process_ms),
+      "heaviest_ms": dict(sorted(children.items(), key=lambda item: -item[1])[:heaviest]),
+    }
+  return results
+
+
+def environment() -> dict:
+  """Return what a result depends on besides the code: versions, machine and commit."""
+  try:
+    commit = subprocess.run(
+      ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+    ).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+    "commit": commit,
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "machine": platform.machine(),
+    "processor": platform.processor(),
+    "cpus": os.cpu_count(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+  }
+
+
+def run(
+  sizes: list[int] = DEFAULT_SIZES,
+  dim: int = 1536,
+  n_queries: int = 50,
+  model: str = eh.GPT_MODEL,
+  work_dir: str | None = None,
+  benchmarks: tuple[str, ...] = BENCHMARKS,
+  seed: int = 0,
+) -> dict:
+  """Run the selected benchmarks and return their results as a JSON-serializable dict."""
+  rng = np.random.default_rng(seed)
+  vocab = vocabulary(rng)
+  results = {
+    "environment": environment(),
+    "params": {"sizes": sizes, "dim": dim, "queries": n_queries, "model": model, "seed": seed},
+  }
+  if "split" in benchmarks:
+    results["split"] = bench_split(rng, vocab, model)
+    print(f"split: {results['split']['chunks_per_s']:.0f} chunks/s")
+  if "num_tokens" in benchmarks:
+    results["num_tokens"] = bench_num_tokens(rng, vocab, model)
+    print(f"num_tokens: {results['num_tokens']['calls_per_s']:.0f} calls/s")
+  if "corpus" in benchmarks:
+    client = SyntheticClient(dim, seed=seed)
+    queries = [synthetic_paragraph(rng, vocab, n_sentences=1) for _ in range(n_queries)]
+    results["corpus"] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+      for n in sizes:
+        path = os.path.join(work_dir or tmp, f"corpus_{n}_{dim}")
+        build_seconds = build_corpus(path, n, dim, rng, vocab, token_model=model)
+        result = bench_corpus(path, client, queries, model)
+        result["build_s"] = build_seconds
+        results["corpus"][str(n)] = result
+        print(
+          f"{n} chunks: load {result['load']['p50_ms']:.2f} ms, search {result['search']['p50_ms']:.2f} ms, "
+          f"query_message {result['query_message']['p50_ms']:.2f} ms (p50)"
+        )
+  if "imports" in benchmarks:
+    results["imports"] = bench_imports()
+    for module, result in results["imports"].items():
+      print(f"import {module}: {result['import_ms']:.0f} ms ({result['process_ms']:.0f} ms with interpreter startup)")
+  return results
+
+
+def _numbers(results: dict, prefix: str = "") -> dict:
+  """Flatten the numeric leaves of a results dict into {"dotted.key": value}."""
+  flat = {}
+  for key, value in results.items():
+    if key in ("environment", "params"):
+      continue
+    if isinstance(value, dict):
+      flat.update(_numbers(value, f"{prefix}{key}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      flat[f"{prefix}{key}"] = value
+  return flat
+
+
+def compare(baseline: dict, results: dict) -> None:
+  """Print every metric present in both runs with its relative change."""
+  old, new = _numbers(baseline), _numbers(results)
+  for key in sorted(old.keys() & new.keys()):
+    change = (new[key] - old[key]) / old[key] * 100 if old[key] else float("nan")
+    print(f"{key}: {old[key]:.4g} -> {new[key]:.4g} ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark chunking, token counting and retrieval on synthetic data.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="corpus sizes, in chunks")
+  parser.add_argument("--dim", type=int, default=1536)
+  parser.add_argument("--queries", type=int, default=50)
+  parser.add_argument("--model", default=eh.GPT_MODEL, help="tokenizer model")
+  parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+  parser.add_argument("--work-dir", default=None, help="keep generated corpora here for later runs")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--out", default=None, help="write the results to this JSON file")
+  parser.add_argument("--baseline", default=None, help="compare with the results of an earlier run")
+  args = parser.parse_args()
+
+  results = run(args.sizes, args.dim, args.queries, args.model, args.work_dir, tuple(args.only), args.seed)
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(results, f, indent=2)
+  if args.baseline:
+    with open(args.baseline) as f:
+      compare(json.load(f), results)
@@ -0,0 +1,209 @@
+# type: ignore
+
+"""Lexical retrieval with a BM25 inverted index, and fusion with vector search.
+
+The postings are stored in CSR form next to an embedding store: the row ids
+and term frequencies of term t are doc_ids[offsets[t]:offsets[t + 1]] and
+term_freqs[offsets[t]:offsets[t + 1]].
+
+  python -m src.bm25 data/oscars_store  # or a sharded store (see src.shards)
+  lexical = BM25Index.load("data/oscars_store", count=len(index))
+  eh.strings_ranked_by_relatedness(query, index, client, lexical_index=lexical, hybrid_mode="rrf")
+
+Hybrid modes:
+  rrf        rank with both BM25 and the vector index, then merge the two rankings
+             with reciprocal rank fusion (good for exact names of films and nominees)
+  prefilter  score only the prefilter_size best BM25 matches with the vector index,
+             instead of scanning every embedding
+"""
+
+import argparse
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from src.embed_index import top_k
+
+BM25_META_FILE = "bm25.json"
+BM25_ARRAYS = ("offsets", "doc_ids", "term_freqs", "doc_lengths")
+HYBRID_MODES = ("rrf", "prefilter")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+  """Return the lowercased word tokens of text."""
+  return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+  """Okapi BM25 over a fixed list of texts, with postings in CSR arrays."""
+
+  def __init__(
+    self,
+    terms: list[str],
+    offsets: np.ndarray,
+    doc_ids: np.ndarray,
+    term_freqs: np.ndarray,
+    doc_lengths: np.ndarray,
+    k1: float = 1.5,
+    b: float = 0.75,
+  ):
+    self.terms = terms
+    self.vocab = {term: i for i, term in enumerate(terms)}
+    self.offsets = offsets
+    self.doc_ids = doc_ids
+    self.term_freqs = term_freqs
+    self.doc_lengths = doc_lengths
+    self.k1 = k1
+    self.b = b
+    average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+    self._length_norms = (k1 * (1 - b + b * doc_lengths / max(average_length, 1e-9))).astype(np.float32)
+    # ^the per-document part of the BM25 denominator, computed once instead of per query term
+
+  @classmethod
+  def build(cls, texts, k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+    """Tokenize every text and invert the counts into postings lists."""
+    vocab = {}
+    term_ids, doc_ids, term_freqs = [], [], []
+    doc_lengths = np.zeros(len(texts), dtype=np.int32)
+    for doc, text in enumerate(texts):
+      tokens = tokenize(text)
+      doc_lengths[doc] = len(tokens)
+      for term, count in Counter(tokens).items():
+        term_ids.append(vocab.setdefault(term, len(vocab)))
+        doc_ids.append(doc)
+        term_freqs.append(count)
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    order = np.argsort(term_ids, kind="stable")
+    # ^stable, so every postings list stays sorted by row id
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(vocab)))]).astype(np.int64)
+    return cls(
+      list(vocab),
+      offsets,
+      np.asarray(doc_ids, dtype=np.int32)[order],
+      np.asarray(term_freqs, dtype=np.int32)[order],
+      doc_lengths,
+      k1=k1,
+      b=b,
+    )
+
+  def __len__(self) -> int:
+    return len(self.doc_lengths)
+
+  def scores(self, query: str) -> np.ndarray:
+    """Return the BM25 score of every row for query (0 for rows sharing no term with it)."""
+    n = len(self)
+    scores = np.zeros(n, dtype=np.float32)
+    for term in set(tokenize(query)):
+      t = self.vocab.get(term)
+      if t is None:
+        continue
+      start, end = self.offsets[t], self.offsets[t + 1]
+      docs = self.doc_ids[start:end]
+      tf = self.term_freqs[start:end].astype(np.float32)
+      idf = np.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+      scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._length_norms[docs])
+      # ^a term occurs once per postings list, so there are no repeated ids in docs
+    return scores
+
+  def search(self, query: str, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+    """Return (row ids, BM25 scores) of the top_n rows matching at least one query term, best first."""
+    scores = self.scores(query)
+    ids = top_k(scores, top_n)
+    ids = ids[scores[ids] > 0]
+    return ids, scores[ids]
+
+  def save(self, path: str) -> None:
+    """Write the postings into a store directory."""
+    for name in BM25_ARRAYS:
+      np.save(os.path.join(path, f"bm25_{name}.npy"), getattr(self, name))
+    with open(os.path.join(path, BM25_META_FILE), "w") as f:
+      json.dump({"k1": self.k1, "b": self.b, "count": len(self), "terms": self.terms}, f)
+
+  @classmethod
+  def load(cls, path: str, count: int | None = None) -> "BM25Index":
+    """Open postings saved into a store directory, memory-mapping the arrays.
+
+    With count (the store's number of rows), postings built for a different
+    number of rows are refused instead of returning ids the store doesn't have.
+    """
+    with open(os.path.join(path, BM25_META_FILE)) as f:
+      meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f"bm25_{name}.npy"), mmap_mode="r") for name in BM25_ARRAYS}
+    indexed = len(arrays["doc_lengths"])
+    if meta.get("count", indexed) != indexed or (count is not None and indexed != count):
+      raise ValueError(
+        f"The BM25 index in {path} covers {indexed} rows but the store has {count}; "
+        f"rebuild it with python -m src.bm25 {path}."
+      )
+    return cls(meta["terms"], k1=meta["k1"], b=meta["b"], **arrays)
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray], top_n: int = 100, k: int = 60) -> tuple[np.ndarray, np.ndarray]:
+  """Merge rankings of row ids (best first) by summing 1 / (k + rank); return (row ids, fused scores)."""
+  rankings = [np.asarray(r, dtype=np.int64) for r in rankings]
+  if not any(len(r) for r in rankings):
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+  ids = np.concatenate(rankings)
+  ranks = np.concatenate([np.arange(1, len(r) + 1) for r in rankings])
+  unique, inverse = np.unique(ids, return_inverse=True)
+  fused = np.bincount(inverse, weights=1 / (k + ranks))
+  best = top_k(fused, top_n)
+  return unique[best], fused[best]
+
+
+def hybrid_search(
+  query: str,
+  query_embedding,
+  index,
+  lexical_index: BM25Index,
+  top_n: int = 100,
+  mode: str = "rrf",
+  depth: int | None = None,
+  prefilter_size: int = 1000,
+  **search_kwargs,
+) -> tuple[np.ndarray, np.ndarray]:
+  """Return (row ids, scores) ranked by both BM25 and the vector index; see the module docstring for modes.
+
+  In rrf mode both rankings go depth deep (default max(top_n, 100)) and the scores
+  are fused ranks. In prefilter mode the scores are the vector index's relatednesses;
+  a query matching no indexed term falls back to a full vector search.
+  search_kwargs (e.g. relatedness_fn) are passed on to index.search.
+  """
+  if mode == "rrf":
+    depth = depth or max(top_n, 100)
+    vector_ids, _ = index.search(query_embedding, top_n=depth, **search_kwargs)
+    lexical_ids, _ = lexical_index.search(query, top_n=depth)
+    lexical_ids = lexical_ids[lexical_ids < len(index)]
+    # ^never return ids past the end of the store
+    return reciprocal_rank_fusion([vector_ids, lexical_ids], top_n=top_n)
+  if mode == "prefilter":
+    candidates, _ = lexical_index.search(query, top_n=prefilter_size)
+    candidates = candidates[candidates < len(index)]
+    # ^never hand the vector index ids past its end
+    if len(candidates) == 0:
+      return index.search(query_embedding, top_n=top_n, **search_kwargs)
+    return index.search(query_embedding, top_n=top_n, candidates=candidates, **search_kwargs)
+  raise ValueError(f"Unknown hybrid mode {mode!r}; expected one of {HYBRID_MODES}.")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Build a BM25 inverted index next to an embedding store.")
+  parser.add_argument("store_path")
+  parser.add_argument("--k1", type=float, default=1.5)
+  parser.add_argument("--b", type=float, default=0.75)
+  args = parser.parse_args()
+  from src.embed_store import load_index
+  from src.shards import SHARDS_FILE, ShardedIndex
+
+  if os.path.exists(os.path.join(args.store_path, SHARDS_FILE)):
+    texts = ShardedIndex.load(args.store_path).texts
+    # ^row ids of a sharded store are global, so one BM25 index covers every shard
+  else:
+    texts = load_index(args.store_path).texts
+  lexical = BM25Index.build(texts, k1=args.k1, b=args.b)
+  lexical.save(args.store_path)
+  print(f"Wrote {len(lexical.terms)} terms and {len(lexical.doc_ids)} postings to {args.store_path}.")
@@ -0,0 +1,164 @@
+# type: ignore
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class SQLiteCache:
+  """Size-bounded key/value cache persisted in SQLite, evicting the least recently used entries.
+
+  With ttl (seconds), entries expire that long after they were stored. Safe to
+  share between threads. hits and misses count lookups since the cache was opened.
+  """
+
+  def __init__(self, path: str, max_entries: int = 10_000, ttl: float | None = None):
+    self.path = path
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute(
+      "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL)"
+    )
+    self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+    columns = [row[1] for row in self._conn.execute("PRAGMA table_info(cache)")]
+    if "expires" not in columns:
+      self._conn.execute("ALTER TABLE cache ADD COLUMN expires REAL")
+      # ^caches written before TTL support keep their entries, which never expire
+    self._conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+  def get(self, key: str) -> bytes | None:
+    """Return the value stored for key, or None if absent or expired, marking it as recently used."""
+    with self._lock:
+      now = time.time()
+      row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+      if row is not None and row[1] is not None and row[1] <= now:
+        self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        row = None
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self._conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+      return row[0]
+
+  def put(self, key: str, value: bytes) -> None:
+    """Store value under key, evicting expired entries, then the oldest ones beyond max_entries."""
+    with self._lock:
+      now = time.time()
+      expires = now + self.ttl if self.ttl is not None else None
+      self._conn.execute(
+        "INSERT OR REPLACE INTO cache (key, value, last_used, expires) VALUES (?, ?, ?, ?)",
+        (key, value, now, expires),
+      )
+      if self.ttl is not None:
+        self._conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+      (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+      if count > self.max_entries:
+        self._conn.execute(
+          "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+          (count - self.max_entries,),
+        )
+
+  def __len__(self) -> int:
+    with self._lock:
+      return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+  def stats(self) -> dict:
+    """Return hit/miss counters and the current number of entries."""
+    lookups = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+      "entries": len(self),
+    }
+
+  def close(self) -> None:
+    with self._lock:
+      self._conn.close()
+
+
+def normalize_query(query: str) -> str:
+  """Return query with case and runs of whitespace folded, so trivially different repeats share a key."""
+  return " ".join(query.split()).casefold()
+
+
+class QueryEmbeddingCache(SQLiteCache):
+  """Persistent cache of query embeddings, keyed by (embedding model, normalized query)."""
+
+  @staticmethod
+  def key(model: str, query: str) -> str:
+    return f"{model}\n{normalize_query(query)}"
+
+  def lookup(self, model: str, query: str) -> np.ndarray | None:
+    """Return the cached embedding of query, or None on a miss."""
+    value = self.get(self.key(model, query))
+    return None if value is None else np.frombuffer(value, dtype=np.float32)
+
+  def store(self, model: str, query: str, embedding: np.ndarray) -> None:
+    """Cache the embedding of query."""
+    self.put(self.key(model, query), np.asarray(embedding, dtype=np.float32).tobytes())
+
+  def embedding(self, client, model: str, query: str) -> np.ndarray:
+    """Return the embedding of query, calling client.embeddings.create only on a cache miss."""
+    embedding = self.lookup(model, query)
+    if embedding is not None:
+      return embedding
+    response = client.embeddings.create(model=model, input=query)
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    self.store(model, query, embedding)
+    return embedding
+
+  def embeddings(self, client, model: str, queries: list[str], max_inputs: int = 2048) -> np.ndarray:
+    """Return the embeddings of many queries, requesting all cache misses in as few calls as possible."""
+    keys = [self.key(model, q) for q in queries]
+    found = {}
+    missing = {}
+    for key, query in zip(keys, queries):
+      if key in found or key in missing:
+        continue
+      value = self.get(key)
+      if value is None:
+        missing[key] = query
+      else:
+        found[key] = np.frombuffer(value, dtype=np.float32)
+    missing_keys = list(missing)
+    for start in range(0, len(missing_keys), max_inputs):
+      batch = missing_keys[start:start + max_inputs]
+      response = client.embeddings.create(model=model, input=[missing[k] for k in batch])
+      for e in response.data:
+        embedding = np.asarray(e.embedding, dtype=np.float32)
+        self.put(batch[e.index], embedding.tobytes())
+        found[batch[e.index]] = embedding
+    return np.stack([found[key] for key in keys])
+
+
+class AnswerCache(SQLiteCache):
+  """Persistent cache of chat completion answers, keyed by (chat model, hash of the exact prompt).
+
+  Only valid for deterministic (temperature=0) completions: the same model and
+  the same retrieved context give the same answer, so a repeat costs only the retrieval.
+  """
+
+  @staticmethod
+  def key(model: str, messages: list[dict]) -> str:
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{model}\n{digest}"
+
+  def lookup(self, model: str, messages: list[dict]) -> str | None:
+    """Return the cached answer to messages, or None on a miss (or once it has expired)."""
+    value = self.get(self.key(model, messages))
+    return None if value is None else value.decode("utf-8")
+
+  def store(self, model: str, messages: list[dict], answer: str) -> None:
+    """Cache the answer to messages, for ttl seconds if the cache has one."""
+    self.put(self.key(model, messages), answer.encode("utf-8"))
@@ -0,0 +1,96 @@
+# type: ignore
+
+"""Lazy section -> clean -> filter -> chunk -> embed -> store pipeline.
+
+Each stage is a generator over the previous one, so only a bounded number of
+sections and chunks are alive at any time, however large the category is:
+
+  sections = wiki_ingest.iter_sections(titles, source)
+  strings = chunks_from_sections(sections, max_tokens=1600)
+  embed_to_store(strings, EmbeddingPipeline(client, EMBEDDING_MODEL), "data/oscars_store")
+"""
+
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+import src.embed_helpers as eh
+from src import ingest
+from src.embed_pipeline import EmbeddingPipeline
+from src.embed_store import StoreWriter
+
+logger = logging.getLogger(__name__)
+
+
+def cleaned(sections: Iterable[tuple[list[str], str]]) -> Iterator[tuple[list[str], str]]:
+  """Yield each section with ingest.clean_section applied."""
+  for section in sections:
+    yield ingest.clean_section(section)
+
+
+def kept(sections: Iterable[tuple[list[str], str]]) -> Iterator[tuple[list[str], str]]:
+  """Yield only the sections ingest.keep_section keeps."""
+  for section in sections:
+    if ingest.keep_section(section):
+      yield section
+
+
+def chunked(
+  sections: Iterable[tuple[list[str], str]],
+  max_tokens: int = 1000,
+  model: str = eh.GPT_MODEL,
+) -> Iterator[str]:
+  """Yield the strings of each section, split to at most max_tokens each."""
+  for section in sections:
+    yield from ingest.split_strings_from_subsection(section, max_tokens=max_tokens, model=model)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+  """Yield lists of up to size consecutive items."""
+  iterator = iter(items)
+  while batch := list(islice(iterator, size)):
+    yield batch
+
+
+def chunks_from_sections(
+  sections: Iterable[tuple[list[str], str]],
+  max_tokens: int = 1000,
+  model: str = eh.GPT_MODEL,
+) -> Iterator[str]:
+  """Yield embeddable strings from raw sections: cleaned, filtered, then split."""
+  return chunked(kept(cleaned(sections)), max_tokens=max_tokens, model=model)
+
+
+def embed_to_store(
+  strings: Iterable[str],
+  pipeline: EmbeddingPipeline,
+  store_path: str,
+  batch_size: int = 1000,
+  max_in_flight: int = 2,
+  token_model: str | None = None,
+) -> int:
+  """Embed strings batch by batch and append them to a new store as they finish.
+
+  Up to max_in_flight batches are embedded while the next ones are still being
+  produced upstream; results are written in input order. Returns the number of
+  strings written. The pipeline must not have a checkpoint_dir, since batches
+  are only known as they stream past.
+  """
+  if pipeline.checkpoint_dir is not None:
+    raise ValueError("embed_to_store streams its batches; use a pipeline without a checkpoint_dir.")
+  in_flight = collections.deque()
+  with ThreadPoolExecutor(max_workers=max_in_flight) as executor, StoreWriter(
+    store_path, model=pipeline.model, token_model=token_model
+  ) as writer:
+    for batch in batched(strings, batch_size):
+      in_flight.append((batch, executor.submit(pipeline.embed, batch)))
+      if len(in_flight) >= max_in_flight:
+        done, future = in_flight.popleft()
+        writer.append(done, future.result())
+    while in_flight:
+      done, future = in_flight.popleft()
+      writer.append(done, future.result())
+  logger.info("Wrote %d strings to %s.", writer.count, store_path)
+  return writer.count
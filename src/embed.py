@@ -1,12 +1,27 @@
 # type: ignore
 
 import src.embed_helpers as eh
-import pickle
+from src.embed_index import EmbeddingIndex
+import src.embed_store as embed_store
+from src.cache import AnswerCache, QueryEmbeddingCache
+import src.ann as ann
+from src.bm25 import BM25_META_FILE, BM25Index
+from src.instrument import LoggingSink
+import logging
 import os
 import openai
-import mwclient  # for downloading example Wikipedia articles
-import pandas as pd
-import ast  # for converting embeddings saved as strings back to arrays
+# the ingestion steps below are commented out; uncomment these imports with them
+# (asking a question doesn't need mwclient, mwparserfromhell or pandas, so they aren't loaded)
+# import pickle
+# import ast  # for converting embeddings saved as strings back to arrays
+# import pandas as pd
+# import src.ingest as ingest
+# import src.wiki_ingest as wiki_ingest
+# import src.chunk_stream as chunk_stream
+# from src.embed_pipeline import EmbeddingPipeline, refresh_store
+
+# progress messages are logged at INFO; set DEBUG to also see each built prompt and every embedded batch
+logging.basicConfig(level=logging.INFO)
 
 client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
@@ -15,9 +30,10 @@ client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 CATEGORY_TITLE = "Category:Academy Awards"
 WIKI_SITE = "en.wikipedia.org"
 
-# site = mwclient.Site(WIKI_SITE)
-# category_page = site.pages[CATEGORY_TITLE]
-# titles = eh.titles_from_category(category_page, max_depth=1)
+# one connection is reused for the category crawl and every page fetch;
+# for an offline run, use wiki_ingest.DirectorySource("data/wikitext") instead
+# source = wiki_ingest.WikiSource(WIKI_SITE)
+# titles = source.titles_from_category(CATEGORY_TITLE, max_depth=1)
 # # ^note: max_depth=1 means we go one level deep in the category tree
 
 # Save titles to disk
@@ -31,12 +47,18 @@ WIKI_SITE = "en.wikipedia.org"
 # print(f"Found {len(titles)} article titles in {CATEGORY_TITLE}.")
 
 
+# # stream sections -> clean -> filter -> chunk -> embed straight into the store,
+# # a batch at a time, so memory stays flat however many articles there are;
+# # the step-by-step version below keeps each stage on disk for inspection
+# sections = wiki_ingest.iter_sections(titles, source)
+# strings = chunk_stream.chunks_from_sections(sections, max_tokens=1600)
+# chunk_stream.embed_to_store(strings, EmbeddingPipeline(client, "text-embedding-3-small"), "data/oscars_store")
+
+
 # split pages into sections
-# may take ~1 minute per 100 articles
-# wikipedia_sections = []
-# for title in titles:
-#   wikipedia_sections.extend(eh.all_subsections_from_title(title, WIKI_SITE))
-# wikipedia_sections = [eh.clean_section(ws) for ws in wikipedia_sections]
+# pages are fetched 50 per request on a few threads and parsed on a process pool
+# wikipedia_sections = list(wiki_ingest.iter_sections(titles, source))
+# wikipedia_sections = [ingest.clean_section(ws) for ws in wikipedia_sections]
 
 # # save sections to disk
 # with open('data/wikipedia_sections.pkl', 'wb') as f:
@@ -51,7 +73,7 @@ WIKI_SITE = "en.wikipedia.org"
 
 # # filter out sections that are too short or not useful
 # original_num_sections = len(wikipedia_sections)
-# wikipedia_sections = [ws for ws in wikipedia_sections if eh.keep_section(ws)]
+# wikipedia_sections = [ws for ws in wikipedia_sections if ingest.keep_section(ws)]
 
 # # save filtered sections to disk
 # with open('data/wikipedia_sections_filtered.pkl', 'wb') as f:
@@ -77,7 +99,7 @@ WIKI_SITE = "en.wikipedia.org"
 # MAX_TOKENS = 1600
 # wikipedia_strings = []
 # for section in wikipedia_sections:
-#   wikipedia_strings.extend(eh.split_strings_from_subsection(section, max_tokens=MAX_TOKENS))
+#   wikipedia_strings.extend(ingest.split_strings_from_subsection(section, max_tokens=MAX_TOKENS))
 
 # # save strings to disk
 # with open('data/wikipedia_strings.pkl', 'wb') as f:
@@ -95,18 +117,15 @@ WIKI_SITE = "en.wikipedia.org"
 # print(wikipedia_strings[1])
 
 # EMBEDDING_MODEL = "text-embedding-3-small"
-# BATCH_SIZE = 1000  # you can submit up to 2048 embedding inputs per request
-
-# embeddings = []
-# for batch_start in range(0, len(wikipedia_strings), BATCH_SIZE):
-#     batch_end = batch_start + BATCH_SIZE
-#     batch = wikipedia_strings[batch_start:batch_end]
-#     print(f"Batch {batch_start} to {batch_end-1}")
-#     response = client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
-#     for i, be in enumerate(response.data):
-#         assert i == be.index  # double check embeddings are in same order as input
-#     batch_embeddings = [e.embedding for e in response.data]
-#     embeddings.extend(batch_embeddings)
+
+# # batches are packed by token count and sent concurrently; finished batches are
+# # checkpointed, so rerunning after a failure only embeds what is missing
+# pipeline = EmbeddingPipeline(client, EMBEDDING_MODEL, checkpoint_dir="data/embedding_checkpoints")
+# embeddings = pipeline.embed(wikipedia_strings).tolist()
+
+# # to refresh an existing store instead, only new or changed strings are embedded
+# # and strings that disappeared are pruned:
+# refresh_store(wikipedia_strings, pipeline, "data/oscars_store")
 
 # df = pd.DataFrame({"text": wikipedia_strings, "embedding": embeddings})
 
@@ -116,20 +135,61 @@ WIKI_SITE = "en.wikipedia.org"
 # download pre-chunked text and pre-computed embeddings
 # this file is ~200 MB, so may take a minute depending on your connection speed
 embeddings_path = "data/oscars.csv"
-df = pd.read_csv(embeddings_path)
-
-# # convert embeddings from CSV str type back to list type
-# df['embedding'] = df['embedding'].apply(ast.literal_eval)
-
-# print(df)
+# the CSV is converted once to a memory-mapped store, which then opens in milliseconds:
+#   python -m src.embed_store data/oscars.csv data/oscars_store --token-model gpt-3.5-turbo
+STORE_PATH = "data/oscars_store"
+
+if os.path.exists(os.path.join(STORE_PATH, embed_store.META_FILE)):
+  index = embed_store.load_index(STORE_PATH)
+  # for large corpora, build an approximate index once with
+  #   python -m src.ann build data/oscars_store
+  # and search only the n_probe nearest clusters instead of every row
+  if os.path.exists(os.path.join(STORE_PATH, ann.CENTROIDS_FILE)):
+    index = ann.IVFIndex.load(STORE_PATH, index=index, n_probe=16)
+  # or, to scan every row on several cores, split the store once with
+  #   python -m src.shards split data/oscars_store data/oscars_shards --shards 8
+  # and open it instead with index = shards.ShardedIndex.load("data/oscars_shards")
+  # exact film and nominee names are matched lexically too once a BM25 index is built with
+  #   python -m src.bm25 data/oscars_store
+  lexical_index = None
+  if os.path.exists(os.path.join(STORE_PATH, BM25_META_FILE)):
+    lexical_index = BM25Index.load(STORE_PATH, count=len(index))
+else:
+  import pandas as pd
+
+  df = pd.read_csv(embeddings_path)
+
+  # # convert embeddings from CSV str type back to list type
+  # df['embedding'] = df['embedding'].apply(ast.literal_eval)
+
+  # print(df)
+
+  # parse and normalize every embedding once, up front, instead of on each query
+  index = EmbeddingIndex.from_dataframe(df)
+  lexical_index = BM25Index.build(index.texts)
+  # ^rebuilt on every run here; converting the CSV to a store once
+  # (python -m src.embed_store data/oscars.csv data/oscars_store, then
+  # python -m src.bm25 data/oscars_store) loads both indexes from disk instead
+
+# repeated questions reuse their query embedding, and their answer when the retrieved context is unchanged
+embedding_cache = QueryEmbeddingCache("data/query_embeddings.sqlite")
+answer_cache = AnswerCache("data/answers.sqlite", ttl=7 * 24 * 3600)
 
 eh.print_spacer()
 
 # examples
-# strings, relatednesses = eh.strings_ranked_by_relatedness("best actor", df, client, top_n=5)
+# strings, relatednesses = eh.strings_ranked_by_relatedness("best actor", index, client, top_n=5, embedding_cache=embedding_cache)
 # for string, relatedness in zip(strings, relatednesses):
 #   print(f"{relatedness=:.3f}")
 #   print(string)
 #   print()
 
-eh.ask('Who won for best lead at the 2024 Oscars?', df, client)
\ No newline at end of file
+eh.ask(
+  'Who won for best lead at the 2024 Oscars?',
+  index,
+  client,
+  embedding_cache=embedding_cache,
+  answer_cache=answer_cache,
+  lexical_index=lexical_index,
+  trace_sink=LoggingSink(),  # logs how long each stage took and how many tokens were used
+)
\ No newline at end of file
@@ -1,13 +1,29 @@
 # type: ignore
 
-import mwparserfromhell  # for splitting Wikipedia articles into sections
-import mwclient
-import re  # for cutting <ref> links out of Wikipedia articles
-import tiktoken  # for counting tokens
-import pandas as pd
-from scipy import spatial  # for calculating vector similarities for search
-import openai
+"""Query side of the Oscars QA example: embedding a question, ranking chunks and asking the chat model.
+
+Only NumPy and this package's own modules are imported here; tiktoken loads on
+the first token count, and the ingestion helpers (Wikipedia fetching and
+chunking, with mwclient and mwparserfromhell) live in src.ingest, which
+eh.split_strings_from_subsection and friends import on first use.
+"""
+
+from __future__ import annotations  # annotations are never evaluated, so pandas is only imported by type checkers
+
+import logging
+from concurrent.futures import ThreadPoolExecutor  # for running chat completions concurrently
+from typing import TYPE_CHECKING
+from src.tokens import count_tokens, count_tokens_batch  # for counting tokens
 import numpy as np
+from src.embed_index import EmbeddingIndex  # for vectorized similarity search
+from src.cache import AnswerCache, QueryEmbeddingCache  # for reusing embeddings and answers of repeated questions
+from src.bm25 import BM25Index, hybrid_search  # for exact-name matches alongside vector search
+from src.instrument import Trace, span  # for per-stage timings of ask
+
+if TYPE_CHECKING:
+  import pandas as pd
+
+logger = logging.getLogger(__name__)
 
 
 GPT_MODEL = "gpt-3.5-turbo"  # only matters insofar as it selects which tokenizer to use
@@ -17,251 +33,171 @@ def print_spacer():
   print("\n" + "-" * 40 + "\n")
 
 
-def titles_from_category(
-  category: mwclient.listing.Category, max_depth: int
-) -> set[str]:
-  """Return a set of page titles in a given Wiki category and its subcategories."""
-  titles = set()
-  for cm in category.members():
-    if type(cm) == mwclient.page.Page:
-      # ^type() used instead of isinstance() to catch match w/ no inheritance
-      titles.add(cm.name)
-    elif isinstance(cm, mwclient.listing.Category) and max_depth > 0:
-      deeper_titles = titles_from_category(cm, max_depth=max_depth - 1)
-      titles.update(deeper_titles)
-  return titles
-
-SECTIONS_TO_IGNORE = [
-  "See also",
-  "References",
-  "External links",
-  "Further reading",
-  "Footnotes",
-  "Bibliography",
-  "Sources",
-  "Citations",
-  "Literature",
-  "Footnotes",
-  "Notes and references",
-  "Photo gallery",
-  "Works cited",
-  "Photos",
-  "Gallery",
-  "Notes",
-  "References and sources",
-  "References and notes",
-]
-
-def all_subsections_from_section(
-  section: mwparserfromhell.wikicode.Wikicode,
-  parent_titles: list[str],
-  sections_to_ignore: set[str],
-) -> list[tuple[list[str], str]]:
-  """
-  From a Wikipedia section, return a flattened list of all nested subsections.
-  Each subsection is a tuple, where:
-    - the first element is a list of parent subtitles, starting with the page title
-    - the second element is the text of the subsection (but not any children)
-  """
-  headings = [str(h) for h in section.filter_headings()]
-  title = headings[0]
-  if title.strip("=" + " ") in sections_to_ignore:
-    # ^wiki headings are wrapped like "== Heading =="
-    return []
-  titles = parent_titles + [title]
-  full_text = str(section)
-  section_text = full_text.split(title)[1]
-  if len(headings) == 1:
-    return [(titles, section_text)]
-  else:
-    first_subtitle = headings[1]
-    section_text = section_text.split(first_subtitle)[0]
-    results = [(titles, section_text)]
-    for subsection in section.get_sections(levels=[len(titles) + 1]):
-      results.extend(all_subsections_from_section(subsection, titles, sections_to_ignore))
-    return results
-
-def all_subsections_from_title(
-  title: str,
-  site_name: str,
-  sections_to_ignore: set[str] = SECTIONS_TO_IGNORE,
-) -> list[tuple[list[str], str]]:
-  """From a Wikipedia page title, return a flattened list of all nested subsections.
-  Each subsection is a tuple, where:
-    - the first element is a list of parent subtitles, starting with the page title
-    - the second element is the text of the subsection (but not any children)
-  """
-  site = mwclient.Site(site_name)
-  page = site.pages[title]
-  text = page.text()
-  parsed_text = mwparserfromhell.parse(text)
-  headings = [str(h) for h in parsed_text.filter_headings()]
-  if headings:
-    summary_text = str(parsed_text).split(headings[0])[0]
-  else:
-    summary_text = str(parsed_text)
-  results = [([title], summary_text)]
-  for subsection in parsed_text.get_sections(levels=[2]):
-    results.extend(all_subsections_from_section(subsection, [title], sections_to_ignore))
-  return results
-
-# clean text
-def clean_section(section: tuple[list[str], str]) -> tuple[list[str], str]:
-  """
-  Return a cleaned up section with:
-    - <ref>xyz</ref> patterns removed
-    - leading/trailing whitespace removed
-  """
-  titles, text = section
-  text = re.sub(r"<ref.*?</ref>", "", text)
-  text = text.strip()
-  return (titles, text)
+INGEST_NAMES = {
+  "titles_from_category",
+  "SECTIONS_TO_IGNORE",
+  "all_subsections_from_section",
+  "sections_from_wikitext",
+  "all_subsections_from_title",
+  "clean_section",
+  "keep_section",
+  "halved_by_delimiter",
+  "truncated_string",
+  "split_strings_from_subsection",
+}
+
+def __getattr__(name: str):
+  """Import src.ingest the first time one of its helpers is looked up here."""
+  if name in INGEST_NAMES:
+    from src import ingest
 
-# filter out short/blank sections
-def keep_section(section: tuple[list[str], str]) -> bool:
-  """Return True if the section should be kept, False otherwise."""
-  titles, text = section
-  if len(text) < 16:
-    return False
-  else:
-    return True
+    return getattr(ingest, name)
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def num_tokens(text: str, model: str = GPT_MODEL) -> int:
   """Return the number of tokens in a string."""
-  encoding = tiktoken.encoding_for_model(model)
-  return len(encoding.encode(text))
-
-def halved_by_delimiter(string: str, delimiter: str = "\n") -> list[str, str]:
-  """Split a string in two, on a delimiter, trying to balance tokens on each side."""
-  chunks = string.split(delimiter)
-  if len(chunks) == 1:
-    return [string, ""]  # no delimiter found
-  elif len(chunks) == 2:
-    return chunks  # no need to search for halfway point
-  else:
-    total_tokens = num_tokens(string)
-    halfway = total_tokens // 2
-    best_diff = halfway
-    for i, chunk in enumerate(chunks):
-      left = delimiter.join(chunks[: i + 1])
-      left_tokens = num_tokens(left)
-      diff = abs(halfway - left_tokens)
-      if diff >= best_diff:
-        break
-      else:
-        best_diff = diff
-    left = delimiter.join(chunks[:i])
-    right = delimiter.join(chunks[i:])
-    return [left, right]
-  
-def truncated_string(
-  string: str,
-  model: str,
-  max_tokens: int,
-  print_warning: bool = True,
-) -> str:
-  """Truncate a string to a maximum number of tokens."""
-  encoding = tiktoken.encoding_for_model(model)
-  encoded_string = encoding.encode(string)
-  truncated_string = encoding.decode(encoded_string[:max_tokens])
-  if print_warning and len(encoded_string) > max_tokens:
-    print(f"Warning: Truncated string from {len(encoded_string)} tokens to {max_tokens} tokens.")
-  return truncated_string
-
-def split_strings_from_subsection(
-  subsection: tuple[list[str], str],
-  max_tokens: int = 1000,
-  model: str = GPT_MODEL,
-  max_recursion: int = 5,
-) -> list[str]:
-  """
-  Split a subsection into a list of subsections, each with no more than max_tokens.
-  Each subsection is a tuple of parent titles [H1, H2, ...] and text (str).
-  """
-  titles, text = subsection
-  string = "\n\n".join(titles + [text])
-  num_tokens_in_string = num_tokens(string)
-  # if length is fine, return string
-  if num_tokens_in_string <= max_tokens:
-    return [string]
-  # if recursion hasn't found a split after X iterations, just truncate
-  elif max_recursion == 0:
-    return [truncated_string(string, model=model, max_tokens=max_tokens)]
-  # otherwise, split in half and recurse
-  else:
-    titles, text = subsection
-    for delimiter in ["\n\n", "\n", ". "]:
-      left, right = halved_by_delimiter(text, delimiter=delimiter)
-      if left == "" or right == "":
-        # if either half is empty, retry with a more fine-grained delimiter
-        continue
-      else:
-        # recurse on each half
-        results = []
-        for half in [left, right]:
-          half_subsection = (titles, half)
-          half_strings = split_strings_from_subsection(
-            half_subsection,
-            max_tokens=max_tokens,
-            model=model,
-            max_recursion=max_recursion - 1,
-          )
-          results.extend(half_strings)
-        return results
-  # otherwise no split was found, so just truncate (should be very rare)
-  return [truncated_string(string, model=model, max_tokens=max_tokens)]
+  return count_tokens(text, model)
+
+def num_tokens_batch(texts: list[str], model: str = GPT_MODEL) -> list[int]:
+  """Return the number of tokens in each of a list of strings."""
+  return count_tokens_batch(texts, model)
 
 
 # search function
 EMBEDDING_MODEL = "text-embedding-3-small"
 
-def strings_ranked_by_relatedness(
+def as_index(df: pd.DataFrame | EmbeddingIndex) -> EmbeddingIndex:
+  """Return df unchanged if it is already a searchable index, otherwise build an EmbeddingIndex from it.
+
+  Anything with EmbeddingIndex's search() and texts counts, e.g. an ann.IVFIndex.
+  """
+  if callable(getattr(type(df), "search", None)):
+    # ^looked up on the type so a DataFrame column named "search" doesn't count
+    return df
+  return EmbeddingIndex.from_dataframe(df)
+
+def query_embedding(
   query: str,
-  df: pd.DataFrame,
   client,
-  relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
-  top_n: int = 100
-) -> tuple[list[str], list[float]]:
-  """Returns a list of strings and relatednesses, sorted from most related to least."""
+  embedding_cache: QueryEmbeddingCache | None = None,
+) -> list[float] | np.ndarray:
+  """Return the embedding of a query, from embedding_cache when it has been asked before."""
+  if embedding_cache is not None:
+    return embedding_cache.embedding(client, EMBEDDING_MODEL, query)
   query_embedding_response = client.embeddings.create(
         model=EMBEDDING_MODEL,
         input=query,
     )
-  query_embedding = np.array(query_embedding_response.data[0].embedding)
-  query_embedding = query_embedding.flatten()  # Ensure the query embedding is 1-D
-
-  def process_embedding(embedding):
-      embedding = np.array(embedding)
-      if embedding.size == 0 or embedding.ndim != 1 or embedding.shape[0] != query_embedding.shape[0]:  # Check for invalid embeddings
-          return None
-      return embedding
-
-  print(f"Query embedding shape: {query_embedding.shape}")
-
-  strings_and_relatednesses = []
-  for i, row in df.iterrows():
-      row_embedding = process_embedding(row["embedding"])
-      if row_embedding is None:  # Skip invalid embeddings
-          print(f"Skipping row {i} due to invalid embedding shape: {row['embedding']}")
-          continue
-      print(f"Row {i} embedding shape: {row_embedding.shape}")
-      relatedness = relatedness_fn(query_embedding, row_embedding)
-      strings_and_relatednesses.append((row["text"], relatedness))
+  return query_embedding_response.data[0].embedding
 
-  strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-  if strings_and_relatednesses:
-      strings, relatednesses = zip(*strings_and_relatednesses)
-      return strings[:top_n], relatednesses[:top_n]
-  else:
-      return [], []
+def query_embeddings(
+  queries: list[str],
+  client,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  max_inputs: int = 2048,
+) -> np.ndarray:
+  """Return the embeddings of many queries as rows of a matrix, in one request per max_inputs queries."""
+  if embedding_cache is not None:
+    return embedding_cache.embeddings(client, EMBEDDING_MODEL, queries, max_inputs=max_inputs)
+  embeddings = []
+  for start in range(0, len(queries), max_inputs):
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=queries[start:start + max_inputs])
+    embeddings.extend(e.embedding for e in sorted(response.data, key=lambda e: e.index))
+  return np.array(embeddings, dtype=np.float32)
 
+def ids_ranked_by_relatedness(
+  query: str,
+  index: EmbeddingIndex,
+  client,
+  relatedness_fn=None,
+  top_n: int = 100,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  first_stage_dims: int | None = None,
+  lexical_index: BM25Index | None = None,
+  hybrid_mode: str = "rrf",
+  trace: Trace | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+  """Returns index row ids and relatednesses, sorted from most related to least."""
+  with span(trace, "embed_query"):
+    embedding = query_embedding(query, client, embedding_cache=embedding_cache)
+  search_kwargs = {"relatedness_fn": relatedness_fn}
+  if first_stage_dims is not None:
+    search_kwargs["first_stage_dims"] = first_stage_dims
+  with span(trace, "search"):
+    if lexical_index is not None:
+      return hybrid_search(query, embedding, index, lexical_index, top_n=top_n, mode=hybrid_mode, **search_kwargs)
+    return index.search(embedding, top_n=top_n, **search_kwargs)
 
+def strings_ranked_by_relatedness(
+  query: str,
+  df: pd.DataFrame | EmbeddingIndex,
+  client,
+  relatedness_fn=None,
+  top_n: int = 100,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  first_stage_dims: int | None = None,
+  lexical_index: BM25Index | None = None,
+  hybrid_mode: str = "rrf",
+) -> tuple[list[str], list[float]]:
+  """Returns a list of strings and relatednesses, sorted from most related to least.
 
-def num_tokens(text: str, model: str = GPT_MODEL) -> int:
-  """Return the number of tokens in a string."""
-  encoding = tiktoken.encoding_for_model(model)
-  return len(encoding.encode(text))
+  df may be a DataFrame with "text" and "embedding" columns, an EmbeddingIndex, or
+  an approximate index such as ann.IVFIndex. Build the index once and pass it in
+  to avoid re-reading the embeddings on every query.
+  relatedness_fn defaults to cosine similarity. Pass an embedding_cache to skip
+  the embeddings API call for questions that have been asked before. With
+  first_stage_dims (e.g. 256), an EmbeddingIndex shortlists on that many leading
+  dimensions and rescores only the shortlist at full dimension.
+  With a lexical_index (bm25.BM25Index over the same texts), BM25 also ranks the
+  texts: hybrid_mode "rrf" fuses both rankings (relatednesses are then fused
+  rank scores), "prefilter" only vector-scores the best lexical matches.
+  """
+  index = as_index(df)
+  ids, relatednesses = ids_ranked_by_relatedness(
+    query,
+    index,
+    client,
+    relatedness_fn=relatedness_fn,
+    top_n=top_n,
+    embedding_cache=embedding_cache,
+    first_stage_dims=first_stage_dims,
+    lexical_index=lexical_index,
+    hybrid_mode=hybrid_mode,
+  )
+  return [index.texts[i] for i in ids], relatednesses.tolist()
+
+def ids_ranked_by_relatedness_batch(
+  queries: list[str],
+  index: EmbeddingIndex,
+  client,
+  top_n: int = 100,
+  embedding_cache: QueryEmbeddingCache | None = None,
+) -> list[tuple[np.ndarray, np.ndarray]]:
+  """Returns (row ids, relatednesses) for each query, embedding all queries in one request.
+
+  An EmbeddingIndex scores them all with matrix-matrix products; other indexes are searched one query at a time.
+  """
+  embeddings = query_embeddings(queries, client, embedding_cache=embedding_cache)
+  if hasattr(index, "search_batch"):
+    return index.search_batch(embeddings, top_n=top_n)
+  return [index.search(e, top_n=top_n) for e in embeddings]
+
+def strings_ranked_by_relatedness_batch(
+  queries: list[str],
+  df: pd.DataFrame | EmbeddingIndex,
+  client,
+  top_n: int = 100,
+  embedding_cache: QueryEmbeddingCache | None = None,
+) -> list[tuple[list[str], list[float]]]:
+  """Returns (strings, relatednesses) for each query, like strings_ranked_by_relatedness, in input order."""
+  index = as_index(df)
+  return [
+    ([index.texts[i] for i in ids], relatednesses.tolist())
+    for ids, relatednesses in ids_ranked_by_relatedness_batch(
+      queries, index, client, top_n=top_n, embedding_cache=embedding_cache
+    )
+  ]
 
 
 # Below, we define a function ask that:
@@ -271,48 +207,186 @@ def num_tokens(text: str, model: str = GPT_MODEL) -> int:
 # Sends the message to GPT
 # Returns GPT's answer
 
+INTRODUCTION = 'Use the below articles on the 2024 Oscars. If the answer cannot be found in the articles, write "I could not find an answer."'
+ARTICLE_HEADER = '\n\nWikipedia article section:\n"""\n'
+ARTICLE_FOOTER = '\n"""'
+
+def article_token_counts(
+  index: EmbeddingIndex,
+  ids: np.ndarray,
+  model: str,
+) -> list[int]:
+  """Return the number of tokens each article adds to the prompt, header and footer included.
+
+  Reuses the per-chunk token counts stored with the index when they were counted
+  for the same model, and tokenizes the articles in one batch otherwise.
+  """
+  if index.token_counts is not None and index.token_model == model:
+    wrapper_tokens = num_tokens(ARTICLE_HEADER + ARTICLE_FOOTER, model=model)
+    return (index.token_counts[ids] + wrapper_tokens).tolist()
+  return num_tokens_batch(
+    [ARTICLE_HEADER + index.texts[i] + ARTICLE_FOOTER for i in ids], model=model
+  )
+
 def query_message(
   query: str,
-  df: pd.DataFrame,
+  df: pd.DataFrame | EmbeddingIndex,
+  client,
   model: str,
-  token_budget: int
+  token_budget: int,
+  skip_oversized: bool = False,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  lexical_index: BM25Index | None = None,
+  hybrid_mode: str = "rrf",
+  trace: Trace | None = None,
 ) -> str:
-  """Return a message for GPT, with relevant source texts pulled from a dataframe."""
-  strings, relatednesses = strings_ranked_by_relatedness(query, df, model)
-  introduction = 'Use the below articles on the 2024 Oscars. If the answer cannot be found in the articles, write "I could not find an answer."'
-  question = f"\n\nQuestion: {query}"
-  message = introduction
-  for string in strings:
-    next_article = f'\n\nWikipedia article section:\n"""\n{string}\n"""'
-    if (
-      num_tokens(message + next_article + question, model=model)
-      > token_budget
-    ):
-      break
-    else:
-      message += next_article
-  return message + question
+  """Return a message for GPT, with relevant source texts pulled from a dataframe.
+
+  Articles are added in order of relatedness until the next one would exceed
+  token_budget. With skip_oversized, an article that doesn't fit is skipped and
+  less related (possibly shorter) articles keep filling the remaining budget.
+  """
+  index = as_index(df)
+  ids, relatednesses = ids_ranked_by_relatedness(
+    query,
+    index,
+    client,
+    embedding_cache=embedding_cache,
+    lexical_index=lexical_index,
+    hybrid_mode=hybrid_mode,
+    trace=trace,
+  )
+  return message_from_ids(query, index, ids, model, token_budget, skip_oversized=skip_oversized, trace=trace)
+
+def message_from_ids(
+  query: str,
+  index: EmbeddingIndex,
+  ids: np.ndarray,
+  model: str,
+  token_budget: int,
+  skip_oversized: bool = False,
+  trace: Trace | None = None,
+) -> str:
+  """Return a message for GPT from already ranked index rows; see query_message."""
+  with span(trace, "build_message"):
+    question = f"\n\nQuestion: {query}"
+    tokens_used = num_tokens(INTRODUCTION + question, model=model)
+    articles = [INTRODUCTION]
+    for i, article_tokens in zip(ids, article_token_counts(index, ids, model)):
+      if tokens_used + article_tokens > token_budget:
+        if skip_oversized:
+          continue
+        break
+      articles.append(ARTICLE_HEADER + index.texts[i] + ARTICLE_FOOTER)
+      tokens_used += article_tokens
+  if trace is not None:
+    trace.set(candidates=len(ids), included=len(articles) - 1, context_tokens=tokens_used)
+  return "".join(articles) + question
 
 
 def ask(
   query: str,
-  df: pd.DataFrame,
+  df: pd.DataFrame | EmbeddingIndex,
+  client,
   model: str = GPT_MODEL,
   token_budget: int = 4096 - 500,
   print_message: bool = False,
+  skip_oversized: bool = False,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  answer_cache: AnswerCache | None = None,
+  lexical_index: BM25Index | None = None,
+  hybrid_mode: str = "rrf",
+  trace_sink=None,
 ) -> str:
-  """Answers a query using GPT and a dataframe of relevant texts and embeddings."""
-  message = query_message(query, df, model=model, token_budget=token_budget)
+  """Answers a query using GPT and a dataframe of relevant texts and embeddings.
+
+  With answer_cache, a question whose retrieved context was answered before is
+  not sent to GPT again. lexical_index and hybrid_mode are as in
+  strings_ranked_by_relatedness. With a trace_sink (see src.instrument), the
+  stage timings and token and chunk counts of the request are emitted to it.
+  """
+  trace = Trace("ask", query=query, model=model) if trace_sink is not None else None
+  message = query_message(
+    query,
+    df,
+    client,
+    model=model,
+    token_budget=token_budget,
+    skip_oversized=skip_oversized,
+    embedding_cache=embedding_cache,
+    lexical_index=lexical_index,
+    hybrid_mode=hybrid_mode,
+    trace=trace,
+  )
   if print_message:
     print(message)
-  messages = [
+  logger.debug("Message for %r:\n%s", query, message)
+  answer = answer_message(message, client, model=model, answer_cache=answer_cache, trace=trace)
+  if trace is not None:
+    trace_sink.emit(trace.to_dict())
+  return answer
+
+
+def chat_messages(message: str) -> list[dict]:
+  """Return the chat messages that ask sends for a built query message."""
+  return [
     {"role": "system", "content": "You answer questions about the 2024 Oscars."},
     {"role": "user", "content": message},
   ]
-  response = client.chat.completions.create(
-    model=model,
-    messages=messages,
-    temperature=0
-  )
+
+def answer_message(
+  message: str,
+  client,
+  model: str = GPT_MODEL,
+  answer_cache: AnswerCache | None = None,
+  trace: Trace | None = None,
+) -> str:
+  """Return GPT's answer to a built query message, from answer_cache when it was answered before."""
+  messages = chat_messages(message)
+  if answer_cache is not None:
+    cached = answer_cache.lookup(model, messages)
+    if trace is not None:
+      trace.set(answer_cached=cached is not None)
+    if cached is not None:
+      return cached
+  with span(trace, "completion"):
+    response = client.chat.completions.create(
+      model=model,
+      messages=messages,
+      temperature=0
+    )
   response_message = response.choices[0].message.content
+  usage = getattr(response, "usage", None)
+  if trace is not None and usage is not None:
+    trace.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+  if answer_cache is not None:
+    answer_cache.store(model, messages, response_message)
   return response_message
+
+
+def ask_batch(
+  queries: list[str],
+  df: pd.DataFrame | EmbeddingIndex,
+  client,
+  model: str = GPT_MODEL,
+  token_budget: int = 4096 - 500,
+  skip_oversized: bool = False,
+  embedding_cache: QueryEmbeddingCache | None = None,
+  max_concurrency: int = 8,
+  answer_cache: AnswerCache | None = None,
+) -> list[str]:
+  """Answers many queries, returning the answers in input order.
+
+  All queries are embedded in one request and searched together; the chat
+  completions then run up to max_concurrency at a time.
+  """
+  index = as_index(df)
+  ranked = ids_ranked_by_relatedness_batch(queries, index, client, embedding_cache=embedding_cache)
+  messages = [
+    message_from_ids(query, index, ids, model, token_budget, skip_oversized=skip_oversized)
+    for query, (ids, _) in zip(queries, ranked)
+  ]
+  with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+    return list(executor.map(
+      lambda message: answer_message(message, client, model=model, answer_cache=answer_cache), messages
+    ))
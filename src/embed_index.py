@@ -0,0 +1,286 @@
+# type: ignore
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCORE_BUFFER_BYTES = 64 * 2**20  # search_batch's default budget for one chunk of query-by-row scores
+
+
+def normalize_rows(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """Return (unit-length rows as contiguous float32, original row norms)."""
+  matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+  norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    normalized = matrix / norms[:, None]
+  return np.ascontiguousarray(normalized), norms
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+  """Return the indices of the k highest scores, sorted from highest to lowest."""
+  n = scores.shape[0]
+  if k <= 0 or n == 0:
+    return np.empty(0, dtype=np.int64)
+  if k < n:
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    # ^only the k winners get fully sorted
+  else:
+    candidates = np.arange(n)
+  return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+  """Return, for each row of a 2-D score array, the column indices of its k highest scores, highest first."""
+  n = scores.shape[1]
+  k = min(k, n)
+  if k <= 0:
+    return np.empty((scores.shape[0], 0), dtype=np.int64)
+  if k < n:
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  else:
+    candidates = np.broadcast_to(np.arange(n), scores.shape)
+  order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+  return np.take_along_axis(candidates, order, axis=1)
+
+
+def parse_embedding(value) -> np.ndarray | None:
+  """Return an embedding as a 1-D float32 array, or None if it can't be read.
+
+  Accepts lists/arrays as well as the "[0.1, 0.2, ...]" strings written by
+  DataFrame.to_csv, so CSVs no longer need ast.literal_eval on every row.
+  """
+  if isinstance(value, str):
+    value = value.strip()
+    if not (value.startswith("[") and value.endswith("]")):
+      return None
+    try:
+      embedding = np.array(value[1:-1].split(","), dtype=np.float32)
+    except ValueError:
+      return None
+  else:
+    try:
+      embedding = np.asarray(value, dtype=np.float32)
+    except (TypeError, ValueError):
+      return None
+  if embedding.ndim != 1 or embedding.size == 0:
+    return None
+  return embedding
+
+
+def most_common_dim(lengths) -> int:
+  """Return the most common embedding length (0 if there are none), taken to be the correct dimension."""
+  lengths = np.asarray(lengths, dtype=np.int64)
+  return int(np.bincount(lengths).argmax()) if len(lengths) else 0
+
+
+class EmbeddingIndex:
+  """All corpus embeddings as one pre-normalized float32 matrix, plus their texts.
+
+  Rows are unit length, so cosine similarity against a query is a single
+  matrix-vector product. The original norms are kept so a custom
+  relatedness_fn still sees the vectors as they were stored. token_counts
+  optionally holds the number of tokens in each text, as counted for token_model.
+
+  prefix_views maps a dimension d to the first d components of every row,
+  renormalized. Models like text-embedding-3-small are trained so such prefixes
+  are embeddings in their own right, which makes them a cheap first stage.
+  """
+
+  def __init__(
+    self,
+    texts,
+    matrix: np.ndarray,
+    norms: np.ndarray | None = None,
+    token_counts: np.ndarray | None = None,
+    token_model: str | None = None,
+  ):
+    if norms is None:
+      matrix, norms = normalize_rows(matrix)
+    if len(texts) != matrix.shape[0]:
+      raise ValueError(f"Got {len(texts)} texts for {matrix.shape[0]} embeddings.")
+    self.texts = texts
+    self.matrix = matrix
+    self.norms = norms
+    self.token_counts = token_counts
+    self.token_model = token_model
+    self.prefix_views = {}
+
+  @classmethod
+  def from_embeddings(cls, texts: list[str], embeddings, dim: int | None = None) -> "EmbeddingIndex":
+    """Build an index, dropping rows whose embedding is invalid or has the wrong dimension.
+
+    If dim is not given, the most common embedding length is assumed to be correct.
+    """
+    parsed = [parse_embedding(e) for e in embeddings]
+    if dim is None:
+      dim = most_common_dim([e.shape[0] for e in parsed if e is not None])
+    keep = [i for i, e in enumerate(parsed) if e is not None and e.shape[0] == dim]
+    if keep:
+      matrix = np.stack([parsed[i] for i in keep])
+    else:
+      matrix = np.empty((0, dim), dtype=np.float32)
+    matrix, norms = normalize_rows(matrix)
+    nonzero = norms > 0
+    # ^cosine similarity is undefined for all-zero vectors
+    if not nonzero.all():
+      keep = [i for i, ok in zip(keep, nonzero) if ok]
+      matrix, norms = np.ascontiguousarray(matrix[nonzero]), norms[nonzero]
+    skipped = len(parsed) - len(keep)
+    if skipped:
+      logger.warning(
+        "Skipped %d of %d rows with invalid embeddings (expected dimension %d).", skipped, len(parsed), dim
+      )
+    return cls([texts[i] for i in keep], matrix, norms)
+
+  @classmethod
+  def from_dataframe(
+    cls,
+    df,
+    text_column: str = "text",
+    embedding_column: str = "embedding",
+    dim: int | None = None,
+  ) -> "EmbeddingIndex":
+    """Build an index from a DataFrame with text and embedding columns.
+
+    Like embed_store.convert_csv, rows with no text (NaN or None) are dropped
+    and other non-string texts are converted with str().
+    """
+    texts, embeddings = [], []
+    missing_texts, converted_texts = 0, 0
+    for text, value in zip(df[text_column].tolist(), df[embedding_column].tolist()):
+      if not isinstance(text, str):
+        if text is None or (isinstance(text, float) and np.isnan(text)):
+          missing_texts += 1
+          continue
+        text = str(text)
+        converted_texts += 1
+      texts.append(text)
+      embeddings.append(value)
+    if missing_texts:
+      logger.warning("Skipped %d rows with no text.", missing_texts)
+    if converted_texts:
+      logger.warning("Converted %d non-string texts to strings.", converted_texts)
+    return cls.from_embeddings(texts, embeddings, dim=dim)
+
+  def __len__(self) -> int:
+    return self.matrix.shape[0]
+
+  @property
+  def dim(self) -> int:
+    return self.matrix.shape[1]
+
+  def prefix_view(self, dims: int) -> np.ndarray:
+    """Return the renormalized first dims components of every row, computing them once."""
+    if dims not in self.prefix_views:
+      if not 0 < dims <= self.dim:
+        raise ValueError(f"Prefix dimension {dims} must be between 1 and {self.dim}.")
+      self.prefix_views[dims], _ = normalize_rows(self.matrix[:, :dims])
+    return self.prefix_views[dims]
+
+  def search(
+    self,
+    query_embedding,
+    top_n: int = 100,
+    relatedness_fn=None,
+    first_stage_dims: int | None = None,
+    shortlist_size: int | None = None,
+    candidates: np.ndarray | None = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return (row ids, relatednesses) of the top_n rows, most related first.
+
+    Without a relatedness_fn, scores are cosine similarities computed in one
+    matrix-vector product. With first_stage_dims, rows are first ranked on
+    that many leading dimensions, and only a shortlist (default 10 * top_n,
+    at least 100) is rescored with the full vectors. With candidates, only
+    those row ids are scored.
+    """
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+    if query_embedding.shape[0] != self.dim:
+      raise ValueError(
+        f"Query embedding has dimension {query_embedding.shape[0]}, index has {self.dim}."
+      )
+    if candidates is not None:
+      candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+      # ^sorted ids read the memory-mapped matrix front to back
+    if relatedness_fn is None:
+      query_norm = np.linalg.norm(query_embedding)
+      if query_norm == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+      query_embedding = query_embedding / query_norm
+      if candidates is not None:
+        scores = self.matrix[candidates] @ query_embedding
+      elif first_stage_dims is not None and first_stage_dims < self.dim:
+        return self._two_stage_search(query_embedding, top_n, first_stage_dims, shortlist_size)
+      else:
+        scores = self.matrix @ query_embedding
+    else:
+      rows = range(len(self)) if candidates is None else candidates
+      scores = np.fromiter(
+        (relatedness_fn(query_embedding, self.matrix[i] * self.norms[i]) for i in rows),
+        dtype=np.float64,
+        count=len(rows),
+      )
+      scores[np.isnan(scores)] = -np.inf
+    ids = top_k(scores, top_n)
+    if candidates is not None:
+      return candidates[ids], scores[ids]
+    return ids, scores[ids]
+
+  def search_batch(
+    self,
+    query_embeddings,
+    top_n: int = 100,
+    chunk_size: int | None = None,
+    max_score_bytes: int = SCORE_BUFFER_BYTES,
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Return (row ids, cosine similarities) of the top_n rows for each query, most related first.
+
+    Queries are scored chunk_size at a time with one matrix-matrix product per
+    chunk, which allocates a chunk_size x len(self) float32 score matrix
+    (256 queries over 1M rows would be 1 GB). If chunk_size is not given it is
+    the most queries whose scores fit in max_score_bytes.
+    """
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    if queries.ndim != 2 or queries.shape[1] != self.dim:
+      raise ValueError(f"Query embeddings have shape {queries.shape}, index has dimension {self.dim}.")
+    if chunk_size is None:
+      chunk_size = max(1, max_score_bytes // (4 * max(len(self), 1)))
+    query_norms = np.linalg.norm(queries, axis=1)
+    results = []
+    for start in range(0, queries.shape[0], chunk_size):
+      chunk = queries[start:start + chunk_size]
+      chunk_norms = query_norms[start:start + chunk_size]
+      with np.errstate(divide="ignore", invalid="ignore"):
+        chunk = chunk / chunk_norms[:, None]
+      scores = chunk @ self.matrix.T
+      ids = top_k_rows(scores, top_n)
+      for row, norm in enumerate(chunk_norms):
+        if norm == 0:
+          results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+        else:
+          results.append((ids[row], scores[row, ids[row]]))
+    return results
+
+  def _two_stage_search(
+    self,
+    query_embedding: np.ndarray,
+    top_n: int,
+    first_stage_dims: int,
+    shortlist_size: int | None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Shortlist on a prefix view, then rescore the shortlist at full dimension."""
+    prefix_query = query_embedding[:first_stage_dims]
+    prefix_norm = np.linalg.norm(prefix_query)
+    if prefix_norm == 0:
+      prefix_query = np.zeros_like(prefix_query)
+    else:
+      prefix_query = prefix_query / prefix_norm
+    if shortlist_size is None:
+      shortlist_size = max(10 * top_n, 100)
+    shortlist = np.sort(top_k(self.prefix_view(first_stage_dims) @ prefix_query, max(shortlist_size, top_n)))
+    # ^sorted ids read the full matrix front to back
+    scores = self.matrix[shortlist] @ query_embedding
+    best = top_k(scores, top_n)
+    return shortlist[best], scores[best]
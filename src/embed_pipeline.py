@@ -0,0 +1,307 @@
+# type: ignore
+
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import openai
+
+from src import embed_store
+from src.tokens import count_tokens_batch
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_INPUTS = 2048  # you can submit up to 2048 embedding inputs per request
+MAX_BATCH_TOKENS = 300_000  # and up to 300k tokens summed over those inputs
+
+RETRYABLE_ERRORS = (
+  openai.RateLimitError,
+  openai.APIConnectionError,
+  openai.APITimeoutError,
+  openai.InternalServerError,
+)
+
+
+def pack_batches(
+  token_counts: list[int],
+  max_tokens: int = MAX_BATCH_TOKENS,
+  max_inputs: int = MAX_BATCH_INPUTS,
+) -> list[tuple[int, int]]:
+  """Group consecutive inputs into (start, end) batches under both a token and an input limit."""
+  batches = []
+  start, batch_tokens = 0, 0
+  for i, n in enumerate(token_counts):
+    if i > start and (batch_tokens + n > max_tokens or i - start >= max_inputs):
+      batches.append((start, i))
+      start, batch_tokens = i, 0
+    batch_tokens += n
+  if start < len(token_counts):
+    batches.append((start, len(token_counts)))
+  return batches
+
+
+def fingerprint(strings: list[str], model: str) -> str:
+  """Return a hash identifying a list of inputs embedded with a model."""
+  digest = hashlib.sha256(model.encode("utf-8"))
+  for s in strings:
+    digest.update(hashlib.sha256(s.encode("utf-8")).digest())
+  return digest.hexdigest()
+
+
+class EmbeddingPipeline:
+  """Embed many strings with concurrent, retried, checkpointed embeddings requests.
+
+  Batches are packed by token count and sent max_workers at a time. With a
+  checkpoint_dir, each finished batch is saved as it completes, and a rerun on
+  the same inputs only requests the batches that are missing.
+  """
+
+  def __init__(
+    self,
+    client,
+    model: str,
+    checkpoint_dir: str | None = None,
+    max_workers: int = 4,
+    max_retries: int = 5,
+    backoff: float = 1.0,
+    max_batch_tokens: int = MAX_BATCH_TOKENS,
+    max_batch_inputs: int = MAX_BATCH_INPUTS,
+  ):
+    self.client = client
+    self.model = model
+    self.checkpoint_dir = checkpoint_dir
+    self.max_workers = max_workers
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_batch_tokens = max_batch_tokens
+    self.max_batch_inputs = max_batch_inputs
+
+  def embed_batch(self, batch: list[str]) -> np.ndarray:
+    """Embed one batch in a single request, retrying transient API errors with exponential backoff."""
+    for attempt in range(self.max_retries + 1):
+      try:
+        response = self.client.embeddings.create(model=self.model, input=batch)
+        break
+      except RETRYABLE_ERRORS:
+        if attempt == self.max_retries:
+          raise
+        time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+    data = sorted(response.data, key=lambda e: e.index)
+    if [e.index for e in data] != list(range(len(batch))):
+      raise ValueError(f"Expected {len(batch)} embeddings, got indexes {[e.index for e in data]}.")
+    return np.array([e.embedding for e in data], dtype=np.float32)
+
+  def _batch_path(self, start: int, end: int) -> str:
+    return os.path.join(self.checkpoint_dir, f"{start:09d}-{end:09d}.npy")
+
+  def _prepare_checkpoint(self, strings: list[str], batches: list[tuple[int, int]]) -> None:
+    """Create the checkpoint directory, or check that it belongs to these inputs."""
+    os.makedirs(self.checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(self.checkpoint_dir, "manifest.json")
+    manifest = {
+      "model": self.model,
+      "fingerprint": fingerprint(strings, self.model),
+      "batches": [list(b) for b in batches],
+    }
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as f:
+        existing = json.load(f)
+      if existing != manifest:
+        raise ValueError(
+          f"Checkpoint directory {self.checkpoint_dir} was created for different inputs or batching."
+        )
+    else:
+      with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+  def embed(self, strings: list[str]) -> np.ndarray:
+    """Return the embeddings of strings as an (n, dim) float32 matrix, in input order."""
+    strings = list(strings)
+    if not strings:
+      return np.empty((0, 0), dtype=np.float32)
+    batches = pack_batches(
+      count_tokens_batch(strings, self.model),
+      max_tokens=self.max_batch_tokens,
+      max_inputs=self.max_batch_inputs,
+    )
+    results = {}
+    pending = batches
+    if self.checkpoint_dir is not None:
+      self._prepare_checkpoint(strings, batches)
+      pending = [b for b in batches if not os.path.exists(self._batch_path(*b))]
+      if len(pending) < len(batches):
+        logger.info("Resuming: %d of %d batches already embedded.", len(batches) - len(pending), len(batches))
+
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      futures = {
+        executor.submit(self.embed_batch, strings[start:end]): (start, end)
+        for start, end in pending
+      }
+      errors = []
+      for future in as_completed(futures):
+        start, end = futures[future]
+        try:
+          embeddings = future.result()
+        except Exception as e:
+          # keep checkpointing the batches that do finish, then fail
+          errors.append(e)
+          continue
+        logger.debug("Batch %d to %d", start, end - 1)
+        if self.checkpoint_dir is None:
+          results[start] = embeddings
+        else:
+          path = self._batch_path(start, end)
+          np.save(path + ".tmp.npy", embeddings)
+          os.replace(path + ".tmp.npy", path)
+          # ^rename so an interrupted write never leaves a partial batch behind
+    if errors:
+      raise errors[0]
+
+    if self.checkpoint_dir is not None:
+      results = {start: np.load(self._batch_path(start, end)) for start, end in batches}
+    return np.concatenate([results[start] for start, _ in batches])
+
+
+def content_hash(text: str, model: str) -> str:
+  """Return the key under which an embedding of text by model can be reused."""
+  return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def sidecar_indexes(path: str) -> list[str]:
+  """Return the names of the indexes saved next to a store's rows: "d{dims}" prefix views, "ivf", "bm25" and quantization modes."""
+  from src import ann, bm25, quantize
+
+  names = [f"d{dims}" for dims in embed_store.read_meta(path).get("prefix_views", [])]
+  if os.path.exists(os.path.join(path, ann.CENTROIDS_FILE)):
+    names.append("ivf")
+  if os.path.exists(os.path.join(path, bm25.BM25_META_FILE)):
+    names.append("bm25")
+  names.extend(mode for mode in quantize.MODES if os.path.exists(os.path.join(path, quantize.QUANTIZED_META_FILE.format(mode=mode))))
+  return names
+
+
+def rebuild_sidecars(old_path: str, new_path: str) -> list[str]:
+  """Build for the store at new_path the indexes (see sidecar_indexes) the store at old_path had; return the ones built.
+
+  IVF keeps its number of lists, BM25 its k1 and b, and PQ its number of
+  subvectors. An index that can't be built is logged and skipped.
+  """
+  from src import ann, bm25, quantize
+
+  names = sidecar_indexes(old_path)
+  built = []
+  for name in names:
+    try:
+      if name.startswith("d"):
+        embed_store.add_prefix_view(new_path, int(name[1:]))
+        built.append(name)
+        continue
+      index = embed_store.load_index(new_path)
+      if name == "ivf":
+        n_lists = len(np.load(os.path.join(old_path, ann.OFFSETS_FILE))) - 1
+        ann.IVFIndex.build(index, n_lists=n_lists).save(new_path)
+      elif name == "bm25":
+        with open(os.path.join(old_path, bm25.BM25_META_FILE)) as f:
+          params = json.load(f)
+        bm25.BM25Index.build(index.texts, k1=params["k1"], b=params["b"]).save(new_path)
+      else:
+        m = 96
+        if name == "pq":
+          m = np.load(os.path.join(old_path, "quantized_pq_codes.npy"), mmap_mode="r").shape[1]
+        quantize.QuantizedIndex.build(index, name, m=m).save(new_path)
+      built.append(name)
+    except Exception:
+      logger.exception("Could not rebuild the %s index for %s; it was dropped.", name, new_path)
+  return built
+
+
+def refresh_store(
+  strings: list[str],
+  pipeline: EmbeddingPipeline,
+  store_path: str,
+  out_path: str | None = None,
+  write_batch_size: int = 10_000,
+  rebuild_indexes: bool = True,
+) -> dict:
+  """Rebuild a store for strings, only embedding the ones it doesn't already hold.
+
+  Each string is keyed by content_hash with the pipeline's model; rows of the
+  existing store with a matching key are copied over, new or changed strings
+  are sent to the API, and strings no longer present are dropped. The store is
+  replaced in place unless out_path is given. The IVF, BM25, quantized and
+  prefix-view indexes of the old store are rebuilt for the new rows, or, without
+  rebuild_indexes, logged as dropped. Returns counts of reused, embedded and
+  removed rows.
+  """
+  strings = list(strings)
+  old_rows = {}
+  old_hashes = []
+  old_index, token_model = None, None
+  if os.path.exists(os.path.join(store_path, embed_store.META_FILE)):
+    meta = embed_store.read_meta(store_path)
+    token_model = meta.get("token_model")
+    old_index = embed_store.load_index(store_path)
+    if meta.get("model") == pipeline.model:
+      old_hashes = [content_hash(text, pipeline.model) for text in old_index.texts]
+      old_rows = {h: i for i, h in enumerate(old_hashes)}
+
+  hashes = [content_hash(s, pipeline.model) for s in strings]
+  first_missing = {}
+  for i, h in enumerate(hashes):
+    if h not in old_rows:
+      first_missing.setdefault(h, i)
+      # ^strings repeated in the input are only embedded once
+  unique_missing = list(first_missing.values())
+  new_embeddings = pipeline.embed([strings[i] for i in unique_missing])
+  new_rows = {hashes[i]: row for row, i in enumerate(unique_missing)}
+
+  target = out_path if out_path is not None else store_path + ".tmp"
+  old_path = store_path + ".old"
+  if out_path is None:
+    for leftover in (target, old_path):
+      shutil.rmtree(leftover, ignore_errors=True)
+      # ^left behind by a refresh that crashed before its final rename
+  with embed_store.StoreWriter(target, model=pipeline.model, token_model=token_model) as writer:
+    for start in range(0, len(strings), write_batch_size):
+      batch = range(start, min(start + write_batch_size, len(strings)))
+      rows = []
+      for i in batch:
+        if hashes[i] in new_rows:
+          rows.append(new_embeddings[new_rows[hashes[i]]])
+        else:
+          row = old_rows[hashes[i]]
+          rows.append(old_index.matrix[row] * old_index.norms[row])
+      writer.append([strings[i] for i in batch], np.stack(rows))
+  if old_index is not None:
+    if rebuild_indexes:
+      built = rebuild_sidecars(store_path, target)
+      if built:
+        logger.info("Rebuilt the %s indexes for the refreshed store.", ", ".join(built))
+    else:
+      dropped = sidecar_indexes(store_path)
+      if dropped:
+        logger.warning("Dropped the %s indexes of %s; rebuild them for the refreshed store.", ", ".join(dropped), store_path)
+  if out_path is None:
+    if os.path.exists(store_path):
+      os.replace(store_path, old_path)
+    os.replace(target, store_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    # ^processes that already opened the old store keep reading its (unlinked) files
+
+  kept = set(hashes)
+  stats = {
+    "reused": sum(1 for h in hashes if h in old_rows),
+    "embedded": len(unique_missing),
+    "removed": 0 if old_index is None else len(old_index) - sum(1 for h in old_hashes if h in kept),
+    # ^counted in rows, so a text stored twice that disappears counts twice
+  }
+  logger.info(
+    "Reused %d embeddings, embedded %d new strings, removed %d.", stats["reused"], stats["embedded"], stats["removed"]
+  )
+  return stats
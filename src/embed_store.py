@@ -0,0 +1,299 @@
+# type: ignore
+
+"""On-disk embedding store that opens with np.memmap.
+
+A store is a directory holding:
+  - meta.json          count, dim, model and format version (written last)
+  - embeddings.f32     row-major float32 matrix of unit-length embeddings
+  - norms.f32          the original embedding norms
+  - texts.bin          the chunk texts, utf-8 encoded back to back
+  - text_offsets.i64   count + 1 byte offsets into texts.bin
+  - token_counts.i32   optional, tokens per text for meta["token_model"]
+  - embeddings_d{d}.f32 optional renormalized d-dim prefix of every embedding,
+                       one per entry of meta["prefix_views"]
+
+Indexes built from the rows (ivf_*, bm25*, quantized_*) are saved next to
+them; starting a new store in the same directory deletes them, and each
+checks its row count against the store when it is loaded.
+
+Every file is raw and append-only while writing, so a store can be built
+incrementally, and opened read-only in milliseconds by several processes
+sharing the same page cache.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+
+from src.embed_index import EmbeddingIndex, most_common_dim, normalize_rows, parse_embedding
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT = 1
+META_FILE = "meta.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+NORMS_FILE = "norms.f32"
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "text_offsets.i64"
+TOKEN_COUNTS_FILE = "token_counts.i32"
+PREFIX_VIEW_FILE = "embeddings_d{dims}.f32"
+SIDECAR_PATTERNS = ("embeddings_d*.f32", "ivf_*", "bm25*", "quantized_*")
+# ^files derived from the rows (prefix views, IVF, BM25, quantized copies), stale once the rows change
+
+
+def _memmap(path: str, dtype, shape: tuple[int, ...]) -> np.ndarray:
+  """Open a raw file read-only, tolerating empty files (which np.memmap rejects)."""
+  if int(np.prod(shape)) == 0:
+    return np.empty(shape, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class TextStore:
+  """Read-only sequence of strings backed by a memory-mapped utf-8 blob."""
+
+  def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+    self.blob = blob
+    self.offsets = offsets
+
+  def __len__(self) -> int:
+    return self.offsets.shape[0] - 1
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    i = int(i)
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("text index out of range")
+    return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+
+class StoreWriter:
+  """Append texts and embeddings to a new store directory.
+
+  Use as a context manager; meta.json is only written on a clean close, so a
+  half-written store is never mistaken for a complete one. With a token_model,
+  the tokens in each text are counted as it is appended and stored alongside.
+  """
+
+  def __init__(
+    self,
+    path: str,
+    model: str | None = None,
+    dim: int | None = None,
+    token_model: str | None = None,
+  ):
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.exists(meta_path):
+      os.remove(meta_path)
+    for pattern in SIDECAR_PATTERNS:
+      for sidecar in glob.glob(os.path.join(path, pattern)):
+        os.remove(sidecar)
+        logger.info("Removed %s, which indexed the previous rows of %s.", os.path.basename(sidecar), path)
+    self.path = path
+    self.model = model
+    self.dim = dim
+    self.token_model = token_model
+    self.count = 0
+    self._text_bytes = 0
+    self._embeddings = open(os.path.join(path, EMBEDDINGS_FILE), "wb")
+    self._norms = open(os.path.join(path, NORMS_FILE), "wb")
+    self._texts = open(os.path.join(path, TEXTS_FILE), "wb")
+    self._offsets = open(os.path.join(path, OFFSETS_FILE), "wb")
+    self._offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+    self._files = [self._embeddings, self._norms, self._texts, self._offsets]
+    self._token_counts = None
+    if token_model is not None:
+      self._token_counts = open(os.path.join(path, TOKEN_COUNTS_FILE), "wb")
+      self._files.append(self._token_counts)
+
+  def append(self, texts: list[str], embeddings, token_counts=None) -> None:
+    """Append a batch of texts with their (not necessarily normalized) embeddings.
+
+    token_counts may be passed when already known; otherwise they are counted
+    if the store has a token_model.
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(texts):
+      raise ValueError(f"Got {len(texts)} texts for embeddings of shape {matrix.shape}.")
+    if self.dim is None:
+      self.dim = matrix.shape[1]
+    elif matrix.shape[1] != self.dim:
+      raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store dimension {self.dim}.")
+    matrix, norms = normalize_rows(matrix)
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = self._text_bytes + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    self._embeddings.write(matrix.tobytes())
+    self._norms.write(norms.tobytes())
+    self._texts.write(b"".join(encoded))
+    self._offsets.write(offsets.tobytes())
+    if self._token_counts is not None:
+      if token_counts is None:
+        from src.tokens import count_tokens_batch
+
+        token_counts = count_tokens_batch(texts, self.token_model)
+      self._token_counts.write(np.asarray(token_counts, dtype=np.int32).tobytes())
+    self._text_bytes = int(offsets[-1]) if len(offsets) else self._text_bytes
+    self.count += len(texts)
+
+  def close(self) -> None:
+    """Flush all files and write meta.json."""
+    for f in self._files:
+      f.close()
+    meta = {
+      "format": STORE_FORMAT,
+      "count": self.count,
+      "dim": self.dim or 0,
+      "model": self.model,
+      "token_model": self.token_model,
+    }
+    with open(os.path.join(self.path, META_FILE), "w") as f:
+      json.dump(meta, f, indent=2)
+
+  def __enter__(self) -> "StoreWriter":
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    if exc_type is None:
+      self.close()
+    else:
+      for f in self._files:
+        f.close()
+
+
+def read_meta(path: str) -> dict:
+  """Return the meta.json of a store, raising if the store is incomplete."""
+  meta_path = os.path.join(path, META_FILE)
+  if not os.path.exists(meta_path):
+    raise FileNotFoundError(f"No embedding store at {path} (missing {META_FILE}).")
+  with open(meta_path) as f:
+    meta = json.load(f)
+  if meta.get("format") != STORE_FORMAT:
+    raise ValueError(f"Unsupported embedding store format {meta.get('format')} at {path}.")
+  return meta
+
+
+def save_index(index: EmbeddingIndex, path: str, model: str | None = None) -> None:
+  """Write an in-memory EmbeddingIndex to a store directory, with its token counts if it has them."""
+  with StoreWriter(path, model=model, dim=index.dim, token_model=index.token_model) as writer:
+    writer.append(list(index.texts), index.matrix * index.norms[:, None], token_counts=index.token_counts)
+
+
+def load_index(path: str) -> EmbeddingIndex:
+  """Open a store as an EmbeddingIndex without reading it into memory."""
+  meta = read_meta(path)
+  count, dim = meta["count"], meta["dim"]
+  offsets = _memmap(os.path.join(path, OFFSETS_FILE), np.int64, (count + 1,))
+  if count == 0:
+    offsets = np.zeros(1, dtype=np.int64)
+  texts = TextStore(
+    _memmap(os.path.join(path, TEXTS_FILE), np.uint8, (int(offsets[-1]),)),
+    offsets,
+  )
+  matrix = _memmap(os.path.join(path, EMBEDDINGS_FILE), np.float32, (count, dim))
+  norms = _memmap(os.path.join(path, NORMS_FILE), np.float32, (count,))
+  token_counts = None
+  if meta.get("token_model") is not None:
+    token_counts = _memmap(os.path.join(path, TOKEN_COUNTS_FILE), np.int32, (count,))
+  index = EmbeddingIndex(texts, matrix, norms, token_counts=token_counts, token_model=meta.get("token_model"))
+  for dims in meta.get("prefix_views", []):
+    index.prefix_views[dims] = _memmap(
+      os.path.join(path, PREFIX_VIEW_FILE.format(dims=dims)), np.float32, (count, dims)
+    )
+  return index
+
+
+def add_prefix_view(path: str, dims: int, chunk_rows: int = 65_536) -> None:
+  """Store a renormalized dims-dimensional prefix of every embedding, for two-stage search."""
+  meta = read_meta(path)
+  index = load_index(path)
+  if not 0 < dims < index.dim:
+    raise ValueError(f"Prefix dimension {dims} must be between 1 and {index.dim - 1}.")
+  with open(os.path.join(path, PREFIX_VIEW_FILE.format(dims=dims)), "wb") as f:
+    for start in range(0, len(index), chunk_rows):
+      view, _ = normalize_rows(index.matrix[start:start + chunk_rows, :dims])
+      f.write(view.tobytes())
+  meta["prefix_views"] = sorted(set(meta.get("prefix_views", [])) | {dims})
+  with open(os.path.join(path, META_FILE), "w") as f:
+    json.dump(meta, f, indent=2)
+
+
+def convert_csv(
+  csv_path: str,
+  path: str,
+  model: str | None = None,
+  chunksize: int = 10_000,
+  token_model: str | None = None,
+  dim: int | None = None,
+) -> int:
+  """Convert a CSV of "text" and "embedding" columns (as written by embed.py) to a store.
+
+  Reads the CSV in chunks so the whole file never has to fit in memory.
+  Without dim, a first pass over the embedding column finds the most common
+  embedding length, as EmbeddingIndex.from_embeddings does. Rows with invalid,
+  wrong-dimension or all-zero embeddings, or with an empty (NaN) text, are
+  skipped; other non-string texts (e.g. a number) are converted with str().
+  Returns the number of rows written.
+  With a token_model, per-chunk token counts are stored too, for prompt budgeting.
+  """
+  import pandas as pd
+
+  if dim is None:
+    lengths = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, usecols=["embedding"]):
+      for value in chunk["embedding"].tolist():
+        embedding = parse_embedding(value)
+        if embedding is not None:
+          lengths.append(embedding.shape[0])
+    dim = most_common_dim(lengths)
+  skipped, missing_texts, converted_texts = 0, 0, 0
+  with StoreWriter(path, model=model, dim=dim, token_model=token_model) as writer:
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+      texts, rows = [], []
+      for text, value in zip(chunk["text"].tolist(), chunk["embedding"].tolist()):
+        if not isinstance(text, str):
+          if text is None or (isinstance(text, float) and np.isnan(text)):
+            missing_texts += 1
+            continue
+          text = str(text)
+          converted_texts += 1
+        embedding = parse_embedding(value)
+        if embedding is None or embedding.shape[0] != dim or not np.any(embedding):
+          skipped += 1
+          continue
+        texts.append(text)
+        rows.append(embedding)
+      if rows:
+        writer.append(texts, np.stack(rows))
+  if skipped:
+    logger.warning("Skipped %d rows with invalid embeddings (expected dimension %d).", skipped, dim)
+  if missing_texts:
+    logger.warning("Skipped %d rows with no text.", missing_texts)
+  if converted_texts:
+    logger.warning("Converted %d non-string texts to strings.", converted_texts)
+  return writer.count
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Convert an embeddings CSV to a memory-mapped embedding store.")
+  parser.add_argument("csv_path", help="CSV with text and embedding columns, e.g. data/oscars.csv")
+  parser.add_argument("store_path", help="output directory, e.g. data/oscars_store")
+  parser.add_argument("--model", default="text-embedding-3-small", help="embedding model recorded in meta.json")
+  parser.add_argument("--token-model", default=None, help="also store per-chunk token counts for this chat model, e.g. gpt-3.5-turbo")
+  parser.add_argument("--dim", type=int, default=None, help="embedding dimension; by default the most common one in the CSV")
+  parser.add_argument("--prefix-dims", type=int, nargs="*", default=[], help="also store shortened views for two-stage search, e.g. 256")
+  args = parser.parse_args()
+  count = convert_csv(args.csv_path, args.store_path, model=args.model, token_model=args.token_model, dim=args.dim)
+  for dims in args.prefix_dims:
+    add_prefix_view(args.store_path, dims)
+  print(f"Wrote {count} embeddings to {args.store_path}.")
@@ -0,0 +1,234 @@
+# type: ignore
+
+"""Ingestion helpers: fetching Wikipedia articles, splitting them into sections,
+and chunking sections to a token budget.
+
+These need mwclient and mwparserfromhell, which the query side (src.embed_helpers)
+never imports; the names are still reachable as eh.<name>, loaded on first use.
+
+  sections = ingest.sections_from_wikitext(title, wikitext)
+  sections = [ingest.clean_section(s) for s in sections if ingest.keep_section(s)]
+  strings = ingest.split_strings_from_subsection(sections[0], max_tokens=1600)
+"""
+
+import logging
+import re  # for cutting <ref> links out of Wikipedia articles
+
+import mwclient
+import mwparserfromhell  # for splitting Wikipedia articles into sections
+import numpy as np
+
+from src.embed_helpers import GPT_MODEL, num_tokens, num_tokens_batch
+from src.tokens import encoding_for
+
+logger = logging.getLogger(__name__)
+
+
+def titles_from_category(
+  category: mwclient.listing.Category, max_depth: int
+) -> set[str]:
+  """Return a set of page titles in a given Wiki category and its subcategories."""
+  titles = set()
+  for cm in category.members():
+    if type(cm) == mwclient.page.Page:
+      # ^type() used instead of isinstance() to catch match w/ no inheritance
+      titles.add(cm.name)
+    elif isinstance(cm, mwclient.listing.Category) and max_depth > 0:
+      deeper_titles = titles_from_category(cm, max_depth=max_depth - 1)
+      titles.update(deeper_titles)
+  return titles
+
+SECTIONS_TO_IGNORE = [
+  "See also",
+  "References",
+  "External links",
+  "Further reading",
+  "Footnotes",
+  "Bibliography",
+  "Sources",
+  "Citations",
+  "Literature",
+  "Footnotes",
+  "Notes and references",
+  "Photo gallery",
+  "Works cited",
+  "Photos",
+  "Gallery",
+  "Notes",
+  "References and sources",
+  "References and notes",
+]
+
+def all_subsections_from_section(
+  section: mwparserfromhell.wikicode.Wikicode,
+  parent_titles: list[str],
+  sections_to_ignore: set[str],
+) -> list[tuple[list[str], str]]:
+  """
+  From a Wikipedia section, return a flattened list of all nested subsections.
+  Each subsection is a tuple, where:
+    - the first element is a list of parent subtitles, starting with the page title
+    - the second element is the text of the subsection (but not any children)
+  """
+  headings = [str(h) for h in section.filter_headings()]
+  title = headings[0]
+  if title.strip("=" + " ") in sections_to_ignore:
+    # ^wiki headings are wrapped like "== Heading =="
+    return []
+  titles = parent_titles + [title]
+  full_text = str(section)
+  section_text = full_text.split(title)[1]
+  if len(headings) == 1:
+    return [(titles, section_text)]
+  else:
+    first_subtitle = headings[1]
+    section_text = section_text.split(first_subtitle)[0]
+    results = [(titles, section_text)]
+    for subsection in section.get_sections(levels=[len(titles) + 1]):
+      results.extend(all_subsections_from_section(subsection, titles, sections_to_ignore))
+    return results
+
+def sections_from_wikitext(
+  title: str,
+  text: str,
+  sections_to_ignore: set[str] = SECTIONS_TO_IGNORE,
+) -> list[tuple[list[str], str]]:
+  """From the raw wikitext of a page, return a flattened list of all nested subsections.
+  Each subsection is a tuple, where:
+    - the first element is a list of parent subtitles, starting with the page title
+    - the second element is the text of the subsection (but not any children)
+  """
+  parsed_text = mwparserfromhell.parse(text)
+  headings = [str(h) for h in parsed_text.filter_headings()]
+  if headings:
+    summary_text = str(parsed_text).split(headings[0])[0]
+  else:
+    summary_text = str(parsed_text)
+  results = [([title], summary_text)]
+  for subsection in parsed_text.get_sections(levels=[2]):
+    results.extend(all_subsections_from_section(subsection, [title], sections_to_ignore))
+  return results
+
+def all_subsections_from_title(
+  title: str,
+  site_name: str,
+  sections_to_ignore: set[str] = SECTIONS_TO_IGNORE,
+  site: mwclient.Site | None = None,
+) -> list[tuple[list[str], str]]:
+  """From a Wikipedia page title, return a flattened list of all nested subsections.
+  Each subsection is a tuple, where:
+    - the first element is a list of parent subtitles, starting with the page title
+    - the second element is the text of the subsection (but not any children)
+  Pass an existing site to reuse its connection across titles.
+  """
+  if site is None:
+    site = mwclient.Site(site_name)
+  page = site.pages[title]
+  text = page.text()
+  return sections_from_wikitext(title, text, sections_to_ignore)
+
+# clean text
+def clean_section(section: tuple[list[str], str]) -> tuple[list[str], str]:
+  """
+  Return a cleaned up section with:
+    - <ref>xyz</ref> patterns removed
+    - leading/trailing whitespace removed
+  """
+  titles, text = section
+  text = re.sub(r"<ref.*?</ref>", "", text)
+  text = text.strip()
+  return (titles, text)
+
+# filter out short/blank sections
+def keep_section(section: tuple[list[str], str]) -> bool:
+  """Return True if the section should be kept, False otherwise."""
+  titles, text = section
+  if len(text) < 16:
+    return False
+  else:
+    return True
+
+def halved_by_delimiter(string: str, delimiter: str = "\n", model: str = GPT_MODEL) -> list[str, str]:
+  """Split a string in two, on a delimiter, trying to balance tokens on each side."""
+  chunks = string.split(delimiter)
+  if len(chunks) == 1:
+    return [string, ""]  # no delimiter found
+  elif len(chunks) == 2:
+    return chunks  # no need to search for halfway point
+  else:
+    # tokenize each chunk once, together with the delimiter in front of it, so
+    # left_tokens[i] is the token count of delimiter.join(chunks[: i + 1])
+    # (up to tokens merging across a chunk boundary, which is rare)
+    pieces = chunks[:1] + [delimiter + chunk for chunk in chunks[1:]]
+    left_tokens = np.cumsum(num_tokens_batch(pieces, model=model))
+    halfway = int(left_tokens[-1]) // 2
+    # left_tokens only grows, so the distance to halfway shrinks until the first
+    # prefix reaching halfway, then grows; split at the closest side of that point
+    if left_tokens[0] == 0:
+      i = 0
+    else:
+      i = int(np.searchsorted(left_tokens, halfway))
+      previous_diff = halfway - left_tokens[i - 1] if i > 0 else halfway
+      if i < len(chunks) and left_tokens[i] - halfway < previous_diff:
+        i += 1
+      i = min(i, len(chunks) - 1)
+    left = delimiter.join(chunks[:i])
+    right = delimiter.join(chunks[i:])
+    return [left, right]
+
+def truncated_string(
+  string: str,
+  model: str,
+  max_tokens: int,
+  print_warning: bool = True,
+) -> str:
+  """Truncate a string to a maximum number of tokens."""
+  encoding = encoding_for(model)
+  encoded_string = encoding.encode_ordinary(string)
+  truncated_string = encoding.decode(encoded_string[:max_tokens])
+  if print_warning and len(encoded_string) > max_tokens:
+    logger.warning("Truncated string from %d tokens to %d tokens.", len(encoded_string), max_tokens)
+  return truncated_string
+
+def split_strings_from_subsection(
+  subsection: tuple[list[str], str],
+  max_tokens: int = 1000,
+  model: str = GPT_MODEL,
+  max_recursion: int = 5,
+) -> list[str]:
+  """
+  Split a subsection into a list of subsections, each with no more than max_tokens.
+  Each subsection is a tuple of parent titles [H1, H2, ...] and text (str).
+  """
+  titles, text = subsection
+  string = "\n\n".join(titles + [text])
+  num_tokens_in_string = num_tokens(string, model=model)
+  # if length is fine, return string
+  if num_tokens_in_string <= max_tokens:
+    return [string]
+  # if recursion hasn't found a split after X iterations, just truncate
+  elif max_recursion == 0:
+    return [truncated_string(string, model=model, max_tokens=max_tokens)]
+  # otherwise, split in half and recurse
+  else:
+    titles, text = subsection
+    for delimiter in ["\n\n", "\n", ". "]:
+      left, right = halved_by_delimiter(text, delimiter=delimiter, model=model)
+      if left == "" or right == "":
+        # if either half is empty, retry with a more fine-grained delimiter
+        continue
+      else:
+        # recurse on each half
+        results = []
+        for half in [left, right]:
+          half_subsection = (titles, half)
+          half_strings = split_strings_from_subsection(
+            half_subsection,
+            max_tokens=max_tokens,
+            model=model,
+            max_recursion=max_recursion - 1,
+          )
+          results.extend(half_strings)
+        return results
+  # otherwise no split was found, so just truncate (should be very rare)
+  return [truncated_string(string, model=model, max_tokens=max_tokens)]
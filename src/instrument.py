@@ -0,0 +1,94 @@
+# type: ignore
+
+"""Per-request timings and counts for the ask path.
+
+A Trace collects named timing spans plus fields such as token and chunk
+counts; a sink receives it as a dict once the request is done:
+
+  sink = MemorySink()
+  eh.ask(query, index, client, trace_sink=sink)
+  sink.records[0]  # {"name": "ask", "total_ms": ..., "spans": {"embed_query": ..., ...}, ...}
+
+Spans recorded by ask: embed_query, search, build_message, completion.
+Fields: candidates, included, context_tokens, prompt_tokens, completion_tokens,
+answer_cached.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+  """Timing spans (in milliseconds) and fields for one request."""
+
+  def __init__(self, name: str, **fields):
+    self.name = name
+    self.fields = fields
+    self.spans = {}
+    self.started_at = time.time()
+    self._start = time.perf_counter()
+
+  @contextmanager
+  def span(self, stage: str):
+    """Time the enclosed block as stage, adding to any earlier time under the same name."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.spans[stage] = self.spans.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+
+  def set(self, **fields) -> None:
+    self.fields.update(fields)
+
+  def to_dict(self) -> dict:
+    return {
+      "name": self.name,
+      "started_at": self.started_at,
+      "total_ms": (time.perf_counter() - self._start) * 1000,
+      "spans": dict(self.spans),
+      **self.fields,
+    }
+
+
+def span(trace: Trace | None, stage: str):
+  """Return trace.span(stage), or a no-op context when there is no trace."""
+  return nullcontext() if trace is None else trace.span(stage)
+
+
+class LoggingSink:
+  """Logs each trace as one JSON line, at level (INFO by default)."""
+
+  def __init__(self, log: logging.Logger | None = None, level: int = logging.INFO):
+    self.log = log or logger
+    self.level = level
+
+  def emit(self, record: dict) -> None:
+    self.log.log(self.level, "%s", json.dumps(record))
+
+
+class JSONLSink:
+  """Appends each trace as one line of JSON to a file; safe to share between threads."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def emit(self, record: dict) -> None:
+    line = json.dumps(record) + "\n"
+    with self._lock, open(self.path, "a") as f:
+      f.write(line)
+
+
+class MemorySink:
+  """Keeps every trace in a list, for tests and notebooks."""
+
+  def __init__(self):
+    self.records = []
+
+  def emit(self, record: dict) -> None:
+    self.records.append(record)
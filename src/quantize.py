@@ -0,0 +1,255 @@
+# type: ignore
+
+"""Compressed embedding storage: float16, per-vector scaled int8, or product quantization.
+
+Quantized codes are written next to a store and searched in place of the
+float32 matrix, which is then only touched to rerank the best candidates:
+
+  python -m src.quantize data/oscars_store --mode int8
+  index = QuantizedIndex.load("data/oscars_store", "int8", rerank=200)
+
+Bytes per 1536-dim embedding: float32 6144, float16 3072, int8 1540, pq (m=96) 96.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.embed_index import EmbeddingIndex, top_k
+
+MODES = ("float16", "int8", "pq")
+QUANTIZED_META_FILE = "quantized_{mode}.json"
+CHUNK_ROWS = 16_384  # rows decoded to float32 at a time while scoring
+
+
+def kmeans(matrix: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+  """Return n_clusters centroids minimizing squared euclidean distance to the rows."""
+  rng = np.random.default_rng(seed)
+  centroids = np.array(matrix[rng.choice(matrix.shape[0], n_clusters, replace=False)], dtype=np.float32)
+  for _ in range(n_iter):
+    labels = _nearest(matrix, centroids)
+    counts = np.bincount(labels, minlength=n_clusters)
+    empty = counts == 0
+    order = np.argsort(labels, kind="stable")
+    starts = np.cumsum(counts) - counts
+    sums = np.add.reduceat(matrix[order], starts[~empty])
+    centroids[~empty] = sums / counts[~empty, None]
+    if empty.any():
+      centroids[empty] = matrix[rng.choice(matrix.shape[0], int(empty.sum()), replace=False)]
+  return centroids
+
+
+def _nearest(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+  """Return the index of the closest centroid (euclidean) for every row."""
+  distances = (centroids ** 2).sum(axis=1) - 2 * (matrix @ centroids.T)
+  # ^|x|^2 is the same for every centroid, so it is left out
+  return np.argmin(distances, axis=1)
+
+
+class ProductQuantizer:
+  """Splits vectors into m subvectors and encodes each as one of 256 centroids (one byte)."""
+
+  def __init__(self, codebooks: np.ndarray):
+    self.codebooks = codebooks  # (m, 256, dim // m)
+
+  @property
+  def m(self) -> int:
+    return self.codebooks.shape[0]
+
+  @classmethod
+  def train(cls, matrix: np.ndarray, m: int, n_iter: int = 20, seed: int = 0) -> "ProductQuantizer":
+    if matrix.shape[1] % m:
+      raise ValueError(f"Dimension {matrix.shape[1]} is not divisible into {m} subvectors.")
+    n_centroids = min(256, matrix.shape[0])
+    sub = matrix.shape[1] // m
+    codebooks = np.zeros((m, 256, sub), dtype=np.float32)
+    for j in range(m):
+      codebooks[j, :n_centroids] = kmeans(
+        np.ascontiguousarray(matrix[:, j * sub:(j + 1) * sub]), n_centroids, n_iter=n_iter, seed=seed + j
+      )
+    return cls(codebooks)
+
+  def encode(self, matrix: np.ndarray) -> np.ndarray:
+    """Return the (n, m) uint8 codes of the rows of matrix."""
+    sub = self.codebooks.shape[2]
+    codes = np.empty((matrix.shape[0], self.m), dtype=np.uint8)
+    for start in range(0, matrix.shape[0], CHUNK_ROWS):
+      chunk = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+      for j in range(self.m):
+        codes[start:start + CHUNK_ROWS, j] = _nearest(chunk[:, j * sub:(j + 1) * sub], self.codebooks[j])
+    return codes
+
+  def distance_table(self, query: np.ndarray) -> np.ndarray:
+    """Return the (m, 256) inner products of each query subvector with each centroid."""
+    return np.einsum("jkd,jd->jk", self.codebooks, query.reshape(self.m, -1))
+
+
+class QuantizedIndex:
+  """Searches compressed embeddings, optionally reranking the best candidates at full precision.
+
+  Queries stay float32 (asymmetric distance computation); only the stored
+  vectors are compressed. With rerank > 0 and a full-precision index, the top
+  max(top_n, rerank) approximate candidates are rescored exactly.
+  """
+
+  def __init__(self, mode: str, data: dict, texts, full: EmbeddingIndex | None = None, rerank: int = 0):
+    if mode not in MODES:
+      raise ValueError(f"Unknown quantization mode {mode!r}; expected one of {MODES}.")
+    self.mode = mode
+    self.data = data
+    self.texts = texts
+    self.full = full
+    self.rerank = rerank
+    self.token_counts = full.token_counts if full is not None else None
+    self.token_model = full.token_model if full is not None else None
+    self._pq = ProductQuantizer(data["codebooks"]) if mode == "pq" else None
+
+  @classmethod
+  def build(cls, index: EmbeddingIndex, mode: str, m: int = 96, rerank: int = 0) -> "QuantizedIndex":
+    """Compress an index's (unit-length) embeddings; m is the number of PQ subvectors."""
+    matrix = index.matrix
+    if mode == "float16":
+      data = {"vectors": np.asarray(matrix, dtype=np.float16)}
+    elif mode == "int8":
+      codes = np.empty(matrix.shape, dtype=np.int8)
+      scales = np.empty(matrix.shape[0], dtype=np.float32)
+      for start in range(0, matrix.shape[0], CHUNK_ROWS):
+        chunk = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+        chunk_scales = np.abs(chunk).max(axis=1) / 127
+        chunk_scales[chunk_scales == 0] = 1
+        codes[start:start + CHUNK_ROWS] = np.round(chunk / chunk_scales[:, None])
+        scales[start:start + CHUNK_ROWS] = chunk_scales
+      data = {"codes": codes, "scales": scales}
+    elif mode == "pq":
+      rng = np.random.default_rng(0)
+      sample = matrix if len(index) <= 65_536 else matrix[np.sort(rng.choice(len(index), 65_536, replace=False))]
+      pq = ProductQuantizer.train(np.asarray(sample, dtype=np.float32), m)
+      data = {"codebooks": pq.codebooks, "codes": pq.encode(matrix)}
+    else:
+      raise ValueError(f"Unknown quantization mode {mode!r}; expected one of {MODES}.")
+    return cls(mode, data, index.texts, full=index, rerank=rerank)
+
+  def __len__(self) -> int:
+    return len(self.texts)
+
+  @property
+  def dim(self) -> int:
+    if self.mode == "float16":
+      return self.data["vectors"].shape[1]
+    if self.mode == "int8":
+      return self.data["codes"].shape[1]
+    return self.data["codebooks"].shape[0] * self.data["codebooks"].shape[2]
+
+  def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+    """Return the approximate cosine similarity of a unit-length query with every row."""
+    n = len(self)
+    if self.mode == "pq":
+      table = self._pq.distance_table(query)
+      codes = self.data["codes"]
+      scores = np.empty(n, dtype=np.float32)
+      subspaces = np.arange(self._pq.m)
+      for start in range(0, n, CHUNK_ROWS):
+        scores[start:start + CHUNK_ROWS] = table[subspaces, codes[start:start + CHUNK_ROWS]].sum(axis=1)
+      return scores
+    stored = self.data["vectors"] if self.mode == "float16" else self.data["codes"]
+    scores = np.empty(n, dtype=np.float32)
+    for start in range(0, n, CHUNK_ROWS):
+      scores[start:start + CHUNK_ROWS] = stored[start:start + CHUNK_ROWS].astype(np.float32) @ query
+      # ^numpy has no fast float16/int8 matmul, so decode a chunk at a time
+    if self.mode == "int8":
+      scores *= self.data["scales"]
+    return scores
+
+  def search(
+    self,
+    query_embedding,
+    top_n: int = 100,
+    relatedness_fn=None,
+    candidates: np.ndarray | None = None,
+    first_stage_dims: int | None = None,
+    shortlist_size: int | None = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return (row ids, relatednesses) of the top_n rows, most related first.
+
+    A custom relatedness_fn needs the full-precision vectors, an explicit set
+    of candidates is small enough to score exactly, and first_stage_dims asks
+    for two-stage search over full-precision prefixes, so all three use the
+    full-precision index.
+    """
+    if relatedness_fn is not None or candidates is not None or first_stage_dims is not None:
+      if self.full is None:
+        raise ValueError(
+          "A custom relatedness_fn, candidate set or first_stage_dims needs the full-precision index."
+        )
+      return self.full.search(
+        query_embedding,
+        top_n=top_n,
+        relatedness_fn=relatedness_fn,
+        candidates=candidates,
+        first_stage_dims=first_stage_dims,
+        shortlist_size=shortlist_size,
+      )
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+    if query_embedding.shape[0] != self.dim:
+      raise ValueError(
+        f"Query embedding has dimension {query_embedding.shape[0]}, index has {self.dim}."
+      )
+    query_norm = np.linalg.norm(query_embedding)
+    if query_norm == 0 or len(self) == 0:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    query_embedding = query_embedding / query_norm
+    scores = self.approximate_scores(query_embedding)
+    if self.rerank and self.full is not None:
+      candidates = np.sort(top_k(scores, max(top_n, self.rerank)))
+      exact = self.full.matrix[candidates] @ query_embedding
+      best = top_k(exact, top_n)
+      return candidates[best], exact[best]
+    ids = top_k(scores, top_n)
+    return ids, scores[ids]
+
+  def save(self, path: str) -> None:
+    """Write the compressed arrays into a store directory."""
+    for name, array in self.data.items():
+      np.save(os.path.join(path, f"quantized_{self.mode}_{name}.npy"), array)
+    with open(os.path.join(path, QUANTIZED_META_FILE.format(mode=self.mode)), "w") as f:
+      json.dump({"mode": self.mode, "arrays": sorted(self.data), "count": len(self)}, f)
+
+  @classmethod
+  def load(cls, path: str, mode: str, rerank: int = 0) -> "QuantizedIndex":
+    """Open compressed arrays saved into a store directory, memory-mapped.
+
+    The full-precision store is opened too (also memory-mapped), but its
+    embedding pages are only read for reranked candidates.
+    """
+    from src.embed_store import load_index
+
+    with open(os.path.join(path, QUANTIZED_META_FILE.format(mode=mode))) as f:
+      meta = json.load(f)
+    data = {
+      name: np.load(os.path.join(path, f"quantized_{mode}_{name}.npy"), mmap_mode="r")
+      for name in meta["arrays"]
+    }
+    full = load_index(path)
+    count = meta.get("count", data["vectors" if mode == "float16" else "codes"].shape[0])
+    if count != len(full):
+      raise ValueError(
+        f"The {mode} quantized index in {path} covers {count} rows but the store has {len(full)}; "
+        f"rebuild it with python -m src.quantize {path} --mode {mode}."
+      )
+    return cls(mode, data, full.texts, full=full, rerank=rerank)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Write compressed embeddings next to an embedding store.")
+  parser.add_argument("store_path")
+  parser.add_argument("--mode", choices=MODES, default="int8")
+  parser.add_argument("--m", type=int, default=96, help="number of PQ subvectors (must divide the dimension)")
+  args = parser.parse_args()
+  from src.embed_store import load_index
+
+  quantized = QuantizedIndex.build(load_index(args.store_path), args.mode, m=args.m)
+  quantized.save(args.store_path)
+  size = sum(a.nbytes for a in quantized.data.values())
+  print(f"Wrote {args.mode} embeddings ({size / 2**20:.1f} MiB) to {args.store_path}.")
@@ -0,0 +1,282 @@
+# type: ignore
+
+"""Long-running question-answering service over a warm, shared embedding index.
+
+  python -m src.serve --store data/oscars_store --port 8000
+
+  GET  /health                     {"status": "ok", "count": ...}
+  GET  /stats                      hit rates of the query embedding and answer caches
+  GET  /search?q=...&top_n=5       {"results": [{"text": ..., "relatedness": ...}, ...]}
+  POST /ask     {"question": ...}  {"answer": ...}
+  POST /reload                     reopens the store and swaps it in (also on SIGHUP)
+
+The index is opened once at startup and shared by every request thread. One
+OpenAI client, with a pooled HTTP connection limit, is shared the same way;
+point OPENAI_BASE_URL at a stub server to run without the real API. Every
+/ask is traced (see src.instrument) to the log, or to --trace-file as JSONL.
+--store may also be a sharded store (see src.shards).
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import openai
+
+import src.embed_helpers as eh
+from src import ann, bm25, embed_store, shards
+from src.cache import AnswerCache, QueryEmbeddingCache
+from src.instrument import JSONLSink, LoggingSink
+
+logger = logging.getLogger(__name__)
+
+
+def load_search_index(store_path: str, n_probe: int = 16):
+  """Open a store, using its IVF index when one has been built; a sharded store is searched a thread per shard."""
+  if os.path.exists(os.path.join(store_path, shards.SHARDS_FILE)):
+    return shards.ShardedIndex.load(store_path)
+  index = embed_store.load_index(store_path)
+  if os.path.exists(os.path.join(store_path, ann.CENTROIDS_FILE)):
+    index = ann.IVFIndex.load(store_path, index=index, n_probe=n_probe)
+  return index
+
+
+def load_lexical_index(store_path: str, count: int | None = None) -> bm25.BM25Index | None:
+  """Open the store's BM25 index, or return None when none has been built; count is the store's row count."""
+  if os.path.exists(os.path.join(store_path, bm25.BM25_META_FILE)):
+    return bm25.BM25Index.load(store_path, count=count)
+  return None
+
+
+def _close(index) -> None:
+  """Release what an index holds beyond memory maps (a ShardedIndex's workers); others have no close()."""
+  close = getattr(index, "close", None)
+  if close is not None:
+    close()
+
+
+class QAService:
+  """Holds the current indexes; reload() swaps in freshly opened ones without pausing requests.
+
+  With a BM25 index in the store, searches are hybrid (see bm25.HYBRID_MODES).
+  """
+
+  def __init__(
+    self,
+    store_path: str,
+    client,
+    embedding_cache: QueryEmbeddingCache | None = None,
+    answer_cache: AnswerCache | None = None,
+    hybrid_mode: str = "rrf",
+    trace_sink=None,
+  ):
+    self.store_path = store_path
+    self.client = client
+    self.embedding_cache = embedding_cache
+    self.answer_cache = answer_cache
+    self.hybrid_mode = hybrid_mode
+    self.trace_sink = trace_sink
+    self._reload_lock = threading.Lock()
+    self._users_lock = threading.Lock()
+    self._users = {}
+    # ^id of an indexes pair -> requests still using it, so a replaced pair is closed after its last one
+    self._indexes = self._open_indexes()
+
+  def _open_indexes(self) -> tuple:
+    index = load_search_index(self.store_path)
+    return index, load_lexical_index(self.store_path, count=len(index))
+
+  @property
+  def index(self):
+    return self._indexes[0]
+
+  def reload(self) -> int:
+    """Open the store again and swap it in; requests already running finish on the old indexes.
+
+    The old search index is closed (e.g. a ShardedIndex's worker pool shut
+    down) once the last of those requests is done.
+    """
+    with self._reload_lock:
+      indexes = self._open_indexes()
+      with self._users_lock:
+        old, self._indexes = self._indexes, indexes
+        # ^a single reference assignment, so every request sees either the old or the new pair
+        idle = id(old) not in self._users
+      if idle:
+        _close(old[0])
+    logger.info("Reloaded %d embeddings from %s.", len(indexes[0]), self.store_path)
+    return len(indexes[0])
+
+  @contextmanager
+  def _using_indexes(self):
+    """Yield the current (index, lexical index) pair, counting this request as one of its users."""
+    with self._users_lock:
+      indexes = self._indexes
+      self._users[id(indexes)] = self._users.get(id(indexes), 0) + 1
+    try:
+      yield indexes
+    finally:
+      with self._users_lock:
+        self._users[id(indexes)] -= 1
+        retired = self._users[id(indexes)] == 0 and indexes is not self._indexes
+        if self._users[id(indexes)] == 0:
+          del self._users[id(indexes)]
+      if retired:
+        _close(indexes[0])
+
+  def search(self, query: str, top_n: int = 5) -> list[dict]:
+    with self._using_indexes() as (index, lexical_index):
+      strings, relatednesses = eh.strings_ranked_by_relatedness(
+        query,
+        index,
+        self.client,
+        top_n=top_n,
+        embedding_cache=self.embedding_cache,
+        lexical_index=lexical_index,
+        hybrid_mode=self.hybrid_mode,
+      )
+    return [{"text": s, "relatedness": r} for s, r in zip(strings, relatednesses)]
+
+  def ask(self, question: str, model: str = eh.GPT_MODEL) -> str:
+    with self._using_indexes() as (index, lexical_index):
+      return eh.ask(
+        question,
+        index,
+        self.client,
+        model=model,
+        embedding_cache=self.embedding_cache,
+        answer_cache=self.answer_cache,
+        lexical_index=lexical_index,
+        hybrid_mode=self.hybrid_mode,
+        trace_sink=self.trace_sink,
+      )
+
+  def stats(self) -> dict:
+    return {
+      name: cache.stats()
+      for name, cache in (("query_embeddings", self.embedding_cache), ("answers", self.answer_cache))
+      if cache is not None
+    }
+
+
+class QAHandler(BaseHTTPRequestHandler):
+  """Routes /health, /stats, /search, /ask and /reload to the server's QAService."""
+
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format: str, *args) -> None:
+    logger.debug("%s - %s", self.address_string(), format % args)
+
+  def _send_json(self, status: int, body: dict) -> None:
+    data = json.dumps(body).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _read_json(self) -> dict:
+    length = int(self.headers.get("Content-Length") or 0)
+    if not length:
+      return {}
+    return json.loads(self.rfile.read(length))
+
+  def _handle(self, route) -> None:
+    try:
+      status, body = route()
+    except (ValueError, KeyError) as e:
+      status, body = 400, {"error": str(e)}
+    except openai.OpenAIError as e:
+      status, body = 502, {"error": f"{type(e).__name__}: {e}"}
+    except Exception as e:
+      logger.exception("Error handling %s %s", self.command, self.path)
+      status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+    self._send_json(status, body)
+
+  def do_GET(self) -> None:
+    url = urlparse(self.path)
+    service = self.server.service
+    if url.path == "/health":
+      self._handle(lambda: (200, {"status": "ok", "count": len(service.index)}))
+    elif url.path == "/stats":
+      self._handle(lambda: (200, service.stats()))
+    elif url.path == "/search":
+      params = parse_qs(url.query)
+
+      def route():
+        if "q" not in params:
+          raise ValueError("Missing query parameter q.")
+        query = params["q"][0]
+        top_n = int(params.get("top_n", ["5"])[0])
+        return 200, {"results": service.search(query, top_n=top_n)}
+
+      self._handle(route)
+    else:
+      self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+  def do_POST(self) -> None:
+    url = urlparse(self.path)
+    service = self.server.service
+    if url.path == "/ask":
+
+      def route():
+        body = self._read_json()
+        if "question" not in body:
+          raise ValueError("Missing JSON field question.")
+        return 200, {"answer": service.ask(body["question"], model=body.get("model", eh.GPT_MODEL))}
+
+      self._handle(route)
+    elif url.path == "/reload":
+      self._handle(lambda: (200, {"count": service.reload()}))
+    else:
+      self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+
+def make_server(service: QAService, host: str = "0.0.0.0", port: int = 8000) -> ThreadingHTTPServer:
+  """Return a threaded HTTP server for service; call serve_forever() on it."""
+  server = ThreadingHTTPServer((host, port), QAHandler)
+  server.daemon_threads = True
+  server.service = service
+  return server
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Serve /search and /ask over an embedding store.")
+  parser.add_argument("--store", default="data/oscars_store")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--max-connections", type=int, default=32, help="pooled connections to the OpenAI API")
+  parser.add_argument("--query-cache", default="data/query_embeddings.sqlite")
+  parser.add_argument("--answer-cache", default="data/answers.sqlite")
+  parser.add_argument("--hybrid-mode", choices=bm25.HYBRID_MODES, default="rrf", help="used when the store has a BM25 index")
+  parser.add_argument("--trace-file", default=None, help="append a JSON line per /ask here instead of logging it")
+  parser.add_argument("--log-level", default="INFO")
+  parser.add_argument("--answer-ttl", type=float, default=7 * 24 * 3600, help="seconds before a cached answer expires")
+  args = parser.parse_args()
+  logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+  client = openai.OpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    http_client=openai.DefaultHttpxClient(
+      limits=httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    ),
+  )
+  service = QAService(
+    args.store,
+    client,
+    embedding_cache=QueryEmbeddingCache(args.query_cache),
+    answer_cache=AnswerCache(args.answer_cache, ttl=args.answer_ttl),
+    hybrid_mode=args.hybrid_mode,
+    trace_sink=JSONLSink(args.trace_file) if args.trace_file else LoggingSink(),
+  )
+  server = make_server(service, args.host, args.port)
+  signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=service.reload).start())
+  logger.info("Serving %d embeddings on http://%s:%d", len(service.index), args.host, args.port)
+  server.serve_forever()
@@ -0,0 +1,284 @@
+# type: ignore
+
+"""Exact search over an embedding store split into shards, one worker per shard.
+
+A sharded store is a directory of ordinary stores (see embed_store) holding
+contiguous row ranges of the original, plus shards.json listing them, so row
+ids are the same as in the unsharded store:
+
+  python -m src.shards split data/oscars_store data/oscars_shards --shards 8
+  python -m src.shards eval data/oscars_shards --workers 1 2 4 8
+
+  index = ShardedIndex.load("data/oscars_shards", workers=8)
+  eh.strings_ranked_by_relatedness(query, index, client)
+
+Each shard is scanned by its own worker and the per-shard top_n are merged
+into the global top_n, which is the same result as scanning one matrix.
+With mode="thread" the workers are threads (NumPy's matrix-vector product
+releases the GIL, so scans run on several cores); with mode="process" they are
+persistent processes that open each shard once and keep it memory-mapped, for
+custom relatedness functions that hold the GIL. In process mode a
+relatedness_fn has to be picklable (a module-level function, not a lambda).
+"""
+
+import argparse
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from src import embed_store
+from src.embed_index import EmbeddingIndex, top_k
+
+SHARDS_FILE = "shards.json"
+SHARD_DIR = "shard_{i:03d}"
+SHARD_MODES = ("thread", "process")
+
+
+def shard_store(path: str, dest: str, n_shards: int, chunk_rows: int = 65_536) -> list[int]:
+  """Split the store at path into n_shards stores of contiguous rows under dest; return the row count of each."""
+  meta = embed_store.read_meta(path)
+  index = embed_store.load_index(path)
+  n = len(index)
+  n_shards = max(1, min(n_shards, n))
+  bounds = np.linspace(0, n, n_shards + 1).astype(np.int64)
+  os.makedirs(dest, exist_ok=True)
+  shards_path = os.path.join(dest, SHARDS_FILE)
+  if os.path.exists(shards_path):
+    os.remove(shards_path)
+  names = []
+  for i, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+    names.append(SHARD_DIR.format(i=i))
+    with embed_store.StoreWriter(
+      os.path.join(dest, names[-1]), model=meta.get("model"), dim=index.dim, token_model=index.token_model
+    ) as writer:
+      for start in range(first, last, chunk_rows):
+        end = min(start + chunk_rows, last)
+        writer.append(
+          index.texts[start:end],
+          index.matrix[start:end] * index.norms[start:end, None],
+          token_counts=None if index.token_counts is None else index.token_counts[start:end],
+        )
+  counts = np.diff(bounds).tolist()
+  with open(shards_path, "w") as f:
+    json.dump({"format": embed_store.STORE_FORMAT, "shards": names, "counts": counts}, f, indent=2)
+  # ^written last, like meta.json, so a half-split directory is never opened
+  return counts
+
+
+def read_shards(path: str) -> dict:
+  """Return the shards.json of a sharded store, raising if there is none."""
+  shards_path = os.path.join(path, SHARDS_FILE)
+  if not os.path.exists(shards_path):
+    raise FileNotFoundError(f"No sharded store at {path} (missing {SHARDS_FILE}).")
+  with open(shards_path) as f:
+    return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def _open_shard(path: str) -> EmbeddingIndex:
+  """Open a shard once per process; later searches reuse its memory maps."""
+  return embed_store.load_index(path)
+
+
+def _call_shard(path: str, method: str, args: tuple, kwargs: dict):
+  """Call a search method of a shard (runs in a worker process)."""
+  return getattr(_open_shard(path), method)(*args, **kwargs)
+
+
+def merge_top_k(results: list[tuple[np.ndarray, np.ndarray]], offsets, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+  """Merge per-shard (local row ids, scores) into the global top_n, shifting ids by each shard's first row."""
+  ids = np.concatenate([np.asarray(r_ids, dtype=np.int64) + offset for (r_ids, _), offset in zip(results, offsets)])
+  scores = np.concatenate([np.asarray(r_scores) for _, r_scores in results])
+  best = top_k(scores, top_n)
+  return ids[best], scores[best]
+
+
+class ShardedTexts:
+  """The texts of all shards as one read-only sequence, indexed by global row id."""
+
+  def __init__(self, shards: list, offsets: np.ndarray):
+    self.shards = shards
+    self.offsets = offsets
+
+  def __len__(self) -> int:
+    return int(self.offsets[-1])
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    i = int(i)
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("text index out of range")
+    shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+    return self.shards[shard][i - self.offsets[shard]]
+
+  def __iter__(self):
+    for shard in self.shards:
+      yield from shard
+
+
+class ShardedIndex:
+  """Shards of an embedding store searched in parallel, searchable like an EmbeddingIndex.
+
+  offsets[i] is the global row id of shard i's first row. The pool is created
+  on the first search and kept until close().
+  """
+
+  def __init__(
+    self,
+    paths: list[str],
+    workers: int | None = None,
+    mode: str = "thread",
+  ):
+    if mode not in SHARD_MODES:
+      raise ValueError(f"Unknown shard mode {mode!r}; expected one of {SHARD_MODES}.")
+    self.paths = paths
+    self.shards = [embed_store.load_index(p) for p in paths]
+    # ^opened here too in process mode, for texts and token counts
+    self.offsets = np.concatenate([[0], np.cumsum([len(s) for s in self.shards])]).astype(np.int64)
+    self.workers = workers or min(len(paths), os.cpu_count() or 1)
+    self.mode = mode
+    self.texts = ShardedTexts([s.texts for s in self.shards], self.offsets)
+    self.token_model = self.shards[0].token_model if self.shards else None
+    self.token_counts = None
+    if self.shards and all(s.token_counts is not None for s in self.shards):
+      self.token_counts = np.concatenate([s.token_counts for s in self.shards])
+      # ^4 bytes a row, so one in-memory copy is cheaper than routing every lookup to its shard
+    self._executor = None
+    self._pool_lock = threading.Lock()
+
+  @classmethod
+  def load(cls, path: str, workers: int | None = None, mode: str = "thread") -> "ShardedIndex":
+    """Open a sharded store written by shard_store."""
+    shards = read_shards(path)
+    return cls([os.path.join(path, name) for name in shards["shards"]], workers=workers, mode=mode)
+
+  def __len__(self) -> int:
+    return int(self.offsets[-1])
+
+  @property
+  def dim(self) -> int:
+    return self.shards[0].dim if self.shards else 0
+
+  def _pool(self):
+    with self._pool_lock:
+      # ^concurrent first searches (e.g. from src.serve's request threads) must share one pool
+      if self._executor is None:
+        if self.mode == "process":
+          self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+          self._executor = ThreadPoolExecutor(max_workers=self.workers)
+      return self._executor
+
+  def _submit(self, shard: int, method: str, *args, **kwargs):
+    """Run a search method of one shard: by path in a worker process, or on the open shard in a thread."""
+    if self.mode == "process":
+      return self._pool().submit(_call_shard, self.paths[shard], method, args, kwargs)
+    return self._pool().submit(getattr(self.shards[shard], method), *args, **kwargs)
+
+  def search(
+    self,
+    query_embedding,
+    top_n: int = 100,
+    relatedness_fn=None,
+    candidates: np.ndarray | None = None,
+    **search_kwargs,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return (row ids, relatednesses) of the top_n rows, most related first.
+
+    Every shard returns its own top_n (or scores only its share of candidates),
+    and the results are merged. search_kwargs (e.g. first_stage_dims) are passed
+    on to each shard's EmbeddingIndex.search.
+    """
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+    if query_embedding.shape[0] != self.dim:
+      raise ValueError(
+        f"Query embedding has dimension {query_embedding.shape[0]}, index has {self.dim}."
+      )
+    search_kwargs["relatedness_fn"] = relatedness_fn
+    shards = range(len(self.shards))
+    shard_kwargs = [search_kwargs] * len(self.shards)
+    if candidates is not None:
+      candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+      bounds = np.searchsorted(candidates, self.offsets)
+      shards = [i for i in shards if bounds[i + 1] > bounds[i]]
+      # ^shards holding no candidate are skipped
+      shard_kwargs = [
+        {**search_kwargs, "candidates": candidates[bounds[i]:bounds[i + 1]] - self.offsets[i]}
+        for i in range(len(self.shards))
+      ]
+    futures = [self._submit(i, "search", query_embedding, top_n=top_n, **shard_kwargs[i]) for i in shards]
+    if not futures:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return merge_top_k([f.result() for f in futures], self.offsets[list(shards)], top_n)
+
+  def search_batch(self, query_embeddings, top_n: int = 100) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Return (row ids, cosine similarities) of the top_n rows for each query, each shard scoring all queries."""
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    futures = [self._submit(i, "search_batch", queries, top_n=top_n) for i in range(len(self.shards))]
+    per_shard = [f.result() for f in futures]
+    return [
+      merge_top_k([results[q] for results in per_shard], self.offsets, top_n) for q in range(queries.shape[0])
+    ]
+
+  def close(self) -> None:
+    """Shut the worker pool down; the next search starts a new one."""
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+
+  def __enter__(self) -> "ShardedIndex":
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    self.close()
+
+
+def _evaluate(path: str, workers: list[int], mode: str, k: int, n_queries: int, seed: int) -> None:
+  """Print mean latency per worker count, checking every result against a single-worker scan."""
+  rng = np.random.default_rng(seed)
+  with ShardedIndex.load(path, workers=1, mode=mode) as index:
+    rows = np.sort(rng.choice(len(index), n_queries, replace=False))
+    shard_of = np.searchsorted(index.offsets, rows, side="right") - 1
+    queries = np.stack([index.shards[s].matrix[r - index.offsets[s]] for s, r in zip(shard_of, rows)])
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+    # ^perturbed so a query is not trivially its own nearest neighbor
+    expected = [index.search(query, top_n=k)[0] for query in queries]
+  for n_workers in workers:
+    with ShardedIndex.load(path, workers=n_workers, mode=mode) as index:
+      index.search(queries[0], top_n=k)
+      # ^starts the pool (and, in process mode, opens the shards) outside the timing
+      start = time.perf_counter()
+      results = [index.search(query, top_n=k)[0] for query in queries]
+      ms = (time.perf_counter() - start) / n_queries * 1000
+    same = all(np.array_equal(a, b) for a, b in zip(expected, results))
+    print(f"workers={n_workers}: {ms:.2f} ms/query{'' if same else ' (results differ!)'}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Split an embedding store into shards, or time sharded search.")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  split = subparsers.add_parser("split", help="write the store's rows into contiguous shards")
+  split.add_argument("store_path")
+  split.add_argument("dest")
+  split.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+  evaluate = subparsers.add_parser("eval", help="time searches with different numbers of workers")
+  evaluate.add_argument("shards_path")
+  evaluate.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+  evaluate.add_argument("--mode", choices=SHARD_MODES, default="thread")
+  evaluate.add_argument("--k", type=int, default=10)
+  evaluate.add_argument("--queries", type=int, default=200)
+  evaluate.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  if args.command == "split":
+    counts = shard_store(args.store_path, args.dest, args.shards)
+    print(f"Wrote {sum(counts)} rows into {len(counts)} shards under {args.dest}.")
+  else:
+    _evaluate(args.shards_path, args.workers, args.mode, args.k, args.queries, args.seed)
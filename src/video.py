@@ -0,0 +1,489 @@
+# type: ignore
+
+"""Sequential frame sampling for video files.
+
+Frames are read forward with grab(), and only the sampled ones are decoded
+with retrieve(). Seeking before every sample instead makes the decoder start
+again from the previous keyframe each time. Frames are yielded one at a time,
+so memory stays bounded on hour-long files:
+
+  for frame in sample_frames("video.mp4", seconds_per_frame=1, max_width=768):
+    ...  # frame.index, frame.timestamp, frame.image (BGR array)
+
+  for frame in encoded_frames("video.mp4", seconds_per_frame=1, quality=80, processes=4):
+    ...  # frame.data is a base64 JPEG, ready for an image_url
+
+With processes, the video is split into time segments that are decoded in
+parallel (one seek per segment) and yielded in order.
+
+Slides and talking heads repeat the same picture for many samples. A
+FrameFilter drops frames whose signature (a dHash, or a small grayscale
+thumbnail) is within a threshold of the last kept frame, and adaptive
+sampling takes frames at a low base rate plus densely around scene changes:
+
+  dedup = FrameFilter("dhash")
+  frames = list(encoded_frames("video.mp4", 2, dedup=dedup, min_seconds_per_frame=0.25))
+  dedup.stats()  # {"kept": ..., "dropped": ...}
+
+preprocess_video samples the frames while ffmpeg extracts the audio track in
+a subprocess, and caches both under a key made of the file's hash and the
+parameters, so preprocessing the same video again only reads the cache:
+
+  frames, audio_path = preprocess_video("video.mp4", 1, max_width=768, cache_dir="data/video_cache")
+
+  python src/video.py  # checks the samplers against a synthetic video and times them
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, Iterator, NamedTuple
+
+import cv2
+import numpy as np
+
+FRAME_METRICS = ("dhash", "diff")
+DEFAULT_THRESHOLDS = {"dhash": 4, "diff": 0.02}  # at or below which a frame counts as a duplicate
+
+
+class Frame(NamedTuple):
+  index: int  # frame number in the video
+  timestamp: float  # seconds from the start
+  image: np.ndarray  # BGR, as decoded by OpenCV, after any resize
+
+
+class EncodedFrame(NamedTuple):
+  index: int
+  timestamp: float
+  data: str  # base64-encoded JPEG
+
+
+def video_info(path: str) -> tuple[int, float]:
+  """Return the (frame count, frames per second) of a video."""
+  video = cv2.VideoCapture(path)
+  if not video.isOpened():
+    raise ValueError(f"Could not open video {path}.")
+  try:
+    return int(video.get(cv2.CAP_PROP_FRAME_COUNT)), video.get(cv2.CAP_PROP_FPS)
+  finally:
+    video.release()
+
+
+def frame_step(fps: float, seconds_per_frame: float) -> int:
+  """Return the number of frames between samples (at least 1)."""
+  return max(1, int(fps * seconds_per_frame))
+
+
+def resized(image: np.ndarray, max_width: int | None = None, max_height: int | None = None) -> np.ndarray:
+  """Return image scaled down, keeping its aspect ratio, to fit max_width x max_height."""
+  height, width = image.shape[:2]
+  scale = min(
+    max_width / width if max_width else 1.0,
+    max_height / height if max_height else 1.0,
+  )
+  if scale >= 1:
+    return image
+  size = (max(1, round(width * scale)), max(1, round(height * scale)))
+  return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def encode_frame(image: np.ndarray, quality: int | None = None) -> str:
+  """Return image as a base64 JPEG; quality (0-100) defaults to OpenCV's 95."""
+  params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality is not None else []
+  ok, buffer = cv2.imencode(".jpg", image, params)
+  if not ok:
+    raise ValueError("Could not encode frame as JPEG.")
+  return base64.b64encode(buffer).decode("utf-8")
+
+
+def sample_frames(
+  path: str,
+  seconds_per_frame: float = 2,
+  start: float = 0.0,
+  end: float | None = None,
+  max_width: int | None = None,
+  max_height: int | None = None,
+  seek_seconds: float | None = 10.0,
+) -> Iterator[Frame]:
+  """Yield one frame every seconds_per_frame between start and end (seconds), in one forward pass.
+
+  Sampled frame numbers are multiples of the frame step, whatever start is, so
+  adjacent time ranges together yield exactly the frames of the whole video.
+  Gaps between samples longer than seek_seconds are jumped with a seek, since
+  keyframes are rarely that far apart; None always reads through.
+  """
+  video = cv2.VideoCapture(path)
+  if not video.isOpened():
+    raise ValueError(f"Could not open video {path}.")
+  try:
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    step = frame_step(fps, seconds_per_frame)
+    seek_frames = None if seek_seconds is None else max(1, int(seek_seconds * fps))
+    stop = total_frames - 1 if end is None else min(round(end * fps), total_frames - 1)
+    next_sample = math.ceil(round(start * fps) / step) * step
+    current = 0
+    if next_sample > 0:
+      video.set(cv2.CAP_PROP_POS_FRAMES, next_sample)
+      # ^one seek per range, not per sample
+      current = next_sample
+    while next_sample < stop:
+      if seek_frames is not None and next_sample - current > seek_frames:
+        video.set(cv2.CAP_PROP_POS_FRAMES, next_sample)
+        current = next_sample
+      if not video.grab():
+        break
+      if current == next_sample:
+        ok, image = video.retrieve()
+        if not ok:
+          break
+        yield Frame(current, current / fps, resized(image, max_width, max_height))
+        next_sample += step
+      current += 1
+  finally:
+    video.release()
+
+
+def thumbnail(image: np.ndarray, size: tuple[int, int] = (32, 18)) -> np.ndarray:
+  """Return a tiny grayscale copy of image with values in [0, 1], for comparing frames."""
+  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+  return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+
+def dhash(image: np.ndarray, hash_size: int = 8) -> int:
+  """Return the difference hash of image: one bit per horizontally adjacent pair of thumbnail pixels."""
+  small = thumbnail(image, (hash_size + 1, hash_size))
+  return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), "big")
+
+
+def frame_signature(image: np.ndarray, metric: str):
+  """Return what FrameFilter compares for metric: a dhash (int) or a thumbnail (array)."""
+  if metric == "dhash":
+    return dhash(image)
+  if metric == "diff":
+    return thumbnail(image)
+  raise ValueError(f"Unknown frame metric {metric!r}; expected one of {FRAME_METRICS}.")
+
+
+def frame_distance(a, b, metric: str) -> float:
+  """Return how different two signatures are: differing dhash bits, or mean absolute thumbnail difference."""
+  if metric == "dhash":
+    return (a ^ b).bit_count()
+  return float(np.abs(a - b).mean())
+
+
+class FrameFilter:
+  """Drops frames within threshold of the last kept frame, counting what it kept and dropped.
+
+  metric "dhash" compares 64-bit difference hashes (threshold in differing
+  bits); "diff" compares 32x18 grayscale thumbnails (threshold in mean
+  absolute difference, 0 to 1).
+  """
+
+  def __init__(self, metric: str = "dhash", threshold: float | None = None):
+    if metric not in FRAME_METRICS:
+      raise ValueError(f"Unknown frame metric {metric!r}; expected one of {FRAME_METRICS}.")
+    self.metric = metric
+    self.threshold = DEFAULT_THRESHOLDS[metric] if threshold is None else threshold
+    self.kept = 0
+    self.dropped = 0
+    self._last = None
+
+  def keep(self, signature) -> bool:
+    """Return whether a frame with this signature is new enough to keep, and remember it if so."""
+    if self._last is not None and frame_distance(self._last, signature, self.metric) <= self.threshold:
+      self.dropped += 1
+      return False
+    self._last = signature
+    self.kept += 1
+    return True
+
+  def filter(self, frames: Iterable[Frame]) -> Iterator[Frame]:
+    """Yield the frames worth keeping."""
+    for frame in frames:
+      if self.keep(frame_signature(frame.image, self.metric)):
+        yield frame
+
+  def stats(self) -> dict:
+    return {"kept": self.kept, "dropped": self.dropped}
+
+
+def adaptive_frames(
+  path: str,
+  seconds_per_frame: float = 2,
+  min_seconds_per_frame: float = 0.25,
+  scene_threshold: float = 0.1,
+  start: float = 0.0,
+  end: float | None = None,
+  max_width: int | None = None,
+  max_height: int | None = None,
+) -> Iterator[Frame]:
+  """Yield a frame every seconds_per_frame, and every min_seconds_per_frame around scene changes.
+
+  The video is sampled at min_seconds_per_frame. A sample whose thumbnail
+  differs from the previous sample's by more than scene_threshold (mean absolute
+  difference, 0 to 1) is a change: it is yielded, together with the sample just
+  before it, so both sides of a cut are seen. Regular samples fall on a fixed
+  frame grid, and two samples before start are decoded for context, so adjacent
+  time ranges together yield exactly the frames of the whole video.
+  """
+  _, fps = video_info(path)
+  dense = frame_step(fps, min_seconds_per_frame)
+  regular = dense * max(1, round(frame_step(fps, seconds_per_frame) / dense))
+  first = math.ceil(round(start * fps) / dense) * dense
+  previous = previous_thumbnail = None
+  previous_yielded = True
+  context_start = max(0, first - 2 * dense) / fps
+  for frame in sample_frames(path, min_seconds_per_frame, context_start, end, max_width, max_height):
+    small = thumbnail(frame.image)
+    changed = previous_thumbnail is not None and float(np.abs(small - previous_thumbnail).mean()) > scene_threshold
+    yielded = changed or frame.index % regular == 0
+    if frame.index >= first:
+      if changed and not previous_yielded:
+        yield previous
+      if yielded:
+        yield frame
+    previous, previous_thumbnail, previous_yielded = frame, small, yielded
+
+
+def _sampled(path: str, start: float, end: float | None, sampling: dict) -> Iterator[Frame]:
+  """Yield frames with sample_frames, or adaptive_frames when sampling has a min_seconds_per_frame."""
+  sampling = dict(sampling)
+  if sampling.get("min_seconds_per_frame"):
+    return adaptive_frames(path, start=start, end=end, **sampling)
+  sampling.pop("min_seconds_per_frame", None)
+  sampling.pop("scene_threshold", None)
+  return sample_frames(path, start=start, end=end, **sampling)
+
+
+def _encoded_segment(
+  path: str,
+  start: float,
+  end: float,
+  sampling: dict,
+  quality: int | None,
+  metric: str | None,
+) -> list[tuple[EncodedFrame, object]]:
+  """Decode, sign and encode the sampled frames of one time segment (runs in a worker process)."""
+  return [
+    (
+      EncodedFrame(f.index, f.timestamp, encode_frame(f.image, quality)),
+      frame_signature(f.image, metric) if metric else None,
+    )
+    for f in _sampled(path, start, end, sampling)
+  ]
+
+
+def encoded_frames(
+  path: str,
+  seconds_per_frame: float = 2,
+  max_width: int | None = None,
+  max_height: int | None = None,
+  quality: int | None = None,
+  processes: int | None = None,
+  segment_seconds: float = 60.0,
+  dedup: FrameFilter | None = None,
+  min_seconds_per_frame: float | None = None,
+  scene_threshold: float = 0.1,
+) -> Iterator[EncodedFrame]:
+  """Yield sampled frames as base64 JPEGs, in order.
+
+  With dedup, frames it drops are never yielded (check dedup.stats() afterwards).
+  With min_seconds_per_frame, sampling is adaptive; see adaptive_frames.
+  With processes, segment_seconds-long time ranges are decoded in a process
+  pool, at most 2 * processes segments ahead of the consumer; near-duplicates
+  are still dropped here, in order, so segments don't reset the comparison.
+  """
+  sampling = {
+    "seconds_per_frame": seconds_per_frame,
+    "max_width": max_width,
+    "max_height": max_height,
+    "min_seconds_per_frame": min_seconds_per_frame,
+    "scene_threshold": scene_threshold,
+  }
+  if not processes:
+    frames = _sampled(path, 0.0, None, sampling)
+    if dedup is not None:
+      frames = dedup.filter(frames)
+    for f in frames:
+      yield EncodedFrame(f.index, f.timestamp, encode_frame(f.image, quality))
+    return
+  total_frames, fps = video_info(path)
+  step = frame_step(fps, min_seconds_per_frame or seconds_per_frame)
+  segment_frames = step * max(1, round(segment_seconds * fps / step))
+  # ^segment boundaries on multiples of the step, so no sample is lost or repeated
+  bounds = [(first / fps, (first + segment_frames) / fps) for first in range(0, total_frames, segment_frames)]
+  metric = dedup.metric if dedup is not None else None
+  in_flight = collections.deque()
+
+  def kept(results):
+    for frame, signature in results:
+      if dedup is None or dedup.keep(signature):
+        yield frame
+
+  with ProcessPoolExecutor(max_workers=processes) as executor:
+    for start, end in bounds:
+      in_flight.append(executor.submit(_encoded_segment, path, start, end, sampling, quality, metric))
+      if len(in_flight) >= 2 * processes:
+        yield from kept(in_flight.popleft().result())
+    while in_flight:
+      yield from kept(in_flight.popleft().result())
+
+
+def ffmpeg_executable() -> str:
+  """Return the ffmpeg on PATH, or else the one bundled with imageio-ffmpeg (installed with moviepy)."""
+  executable = shutil.which("ffmpeg")
+  if executable:
+    return executable
+  try:
+    import imageio_ffmpeg
+  except ImportError:
+    raise FileNotFoundError("ffmpeg not found; install it or imageio-ffmpeg.") from None
+  return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def extract_audio(path: str, audio_path: str, bitrate: str = "32k") -> str:
+  """Write the audio track of a video to audio_path (format from its extension) with ffmpeg, and return audio_path."""
+  command = [ffmpeg_executable(), "-nostdin", "-loglevel", "error", "-y", "-i", path, "-vn", "-b:a", bitrate, audio_path]
+  result = subprocess.run(command, capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError(f"ffmpeg could not extract the audio of {path}: {result.stderr.strip()}")
+  return audio_path
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+  """Return the SHA-256 of a file's contents, read block_size bytes at a time."""
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    while block := f.read(block_size):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def preprocess_video(
+  path: str,
+  seconds_per_frame: float = 2,
+  max_width: int | None = None,
+  max_height: int | None = None,
+  quality: int | None = None,
+  processes: int | None = None,
+  dedup: FrameFilter | None = None,
+  min_seconds_per_frame: float | None = None,
+  audio_bitrate: str = "32k",
+  audio_path: str | None = None,
+  cache_dir: str | None = None,
+) -> tuple[list[EncodedFrame], str]:
+  """Return the sampled frames (see encoded_frames) and the path of the extracted MP3 audio.
+
+  The audio is extracted by ffmpeg in a background thread while the frames are
+  sampled. With cache_dir, results are kept in a subdirectory named by the hash
+  of the file and the parameters, and audio_path is ignored; otherwise the audio
+  goes to audio_path, by default next to the video. dedup stats only count
+  frames sampled by this call, not ones read from the cache.
+  """
+  params = {
+    "seconds_per_frame": seconds_per_frame,
+    "max_width": max_width,
+    "max_height": max_height,
+    "quality": quality,
+    "dedup": [dedup.metric, dedup.threshold] if dedup is not None else None,
+    "min_seconds_per_frame": min_seconds_per_frame,
+    "audio_bitrate": audio_bitrate,
+  }
+  # ^processes is left out: it changes how the frames are decoded, not which
+  if cache_dir is not None:
+    key = hashlib.sha256(f"{file_hash(path)}\n{json.dumps(params, sort_keys=True)}".encode("utf-8")).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    frames_path = os.path.join(entry, "frames.json")
+    audio_path = os.path.join(entry, "audio.mp3")
+    if os.path.exists(frames_path) and os.path.exists(audio_path):
+      with open(frames_path) as f:
+        return [EncodedFrame(*frame) for frame in json.load(f)], audio_path
+    os.makedirs(entry, exist_ok=True)
+  else:
+    audio_path = audio_path or f"{os.path.splitext(path)[0]}.mp3"
+  root, ext = os.path.splitext(audio_path)
+  partial_audio = f"{root}.partial{ext}"
+  # ^written under another name first, so an interrupted run never leaves a cache entry that looks complete
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    audio = executor.submit(extract_audio, path, partial_audio, audio_bitrate)
+    frames = list(
+      encoded_frames(
+        path,
+        seconds_per_frame,
+        max_width=max_width,
+        max_height=max_height,
+        quality=quality,
+        processes=processes,
+        dedup=dedup,
+        min_seconds_per_frame=min_seconds_per_frame,
+      )
+    )
+    os.replace(audio.result(), audio_path)
+  if cache_dir is not None:
+    with open(f"{frames_path}.partial", "w") as f:
+      json.dump([list(frame) for frame in frames], f)
+    os.replace(f"{frames_path}.partial", frames_path)
+  return frames, audio_path
+
+
+def write_synthetic_video(
+  path: str,
+  seconds: float = 20,
+  fps: float = 30,
+  size: tuple[int, int] = (640, 360),
+) -> None:
+  """Write a test video whose frames show their own index as a row of 16 black or white blocks."""
+  width, height = size
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+  gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+  block = width // 16
+  for i in range(int(seconds * fps)):
+    image = np.dstack([np.roll(gradient, 4 * i, axis=1)] * 3)
+    for bit in range(16):
+      image[:height // 4, bit * block:(bit + 1) * block] = 255 if i >> bit & 1 else 0
+    writer.write(image)
+  writer.release()
+
+
+def synthetic_frame_index(image: np.ndarray) -> int:
+  """Read back the index drawn by write_synthetic_video (from an unresized frame)."""
+  height, width = image.shape[:2]
+  block = width // 16
+  top = image[:height // 4].mean(axis=(0, 2))
+  return sum(1 << bit for bit in range(16) if top[bit * block:(bit + 1) * block].mean() > 127)
+
+
+if __name__ == "__main__":
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "synthetic.mp4")
+    write_synthetic_video(path, seconds=60)
+    total_frames, fps = video_info(path)
+    expected = list(range(0, total_frames - 1, frame_step(fps, 1)))
+
+    start = time.perf_counter()
+    frames = list(sample_frames(path, 1))
+    sequential_seconds = time.perf_counter() - start
+    assert [f.index for f in frames] == expected
+    assert [synthetic_frame_index(f.image) for f in frames] == expected
+
+    start = time.perf_counter()
+    parallel = list(encoded_frames(path, 1, processes=4, segment_seconds=10))
+    parallel_seconds = time.perf_counter() - start
+    assert [f.index for f in parallel] == expected
+    sparse = list(sample_frames(path, 15, seek_seconds=5))
+    assert [synthetic_frame_index(f.image) for f in sparse] == [f.index for f in sparse]
+    adaptive = [f.index for f in adaptive_frames(path, 4, 0.5, scene_threshold=0.05)]
+    segmented = encoded_frames(path, 4, processes=4, segment_seconds=10, min_seconds_per_frame=0.5, scene_threshold=0.05)
+    assert [f.index for f in segmented] == adaptive
+
+    print(f"{len(expected)} frames sampled from {total_frames}.")
+    print(f"sequential: {sequential_seconds:.2f}s, 4 processes: {parallel_seconds:.2f}s")
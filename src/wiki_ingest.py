@@ -0,0 +1,178 @@
+# type: ignore
+
+import collections
+import os
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Iterator
+
+import mwclient  # for downloading example Wikipedia articles
+
+from src import ingest
+
+MAX_TITLES_PER_QUERY = 50  # the MediaWiki API returns content for up to 50 titles per request
+
+
+class WikiSource:
+  """Fetches raw wikitext from a MediaWiki site, reusing one connection for every request."""
+
+  def __init__(self, site_name: str = "en.wikipedia.org", site: mwclient.Site | None = None):
+    self.site = site if site is not None else mwclient.Site(site_name)
+
+  def fetch(self, titles: list[str]) -> dict[str, str]:
+    """Return {title: wikitext} for up to MAX_TITLES_PER_QUERY titles in one request.
+
+    Missing pages map to "", as mwclient's Page.text() does. When the content
+    of every page doesn't fit in one response, the API returns the rest of the
+    pages without revisions and a continue token; it is followed until every
+    page has its text.
+    """
+    requested = {}
+    texts, missing = {}, set()
+    continuation = {}
+    while True:
+      response = self.site.get(
+        "query",
+        prop="revisions",
+        rvprop="content",
+        rvslots="main",
+        titles="|".join(titles),
+        formatversion=2,
+        **continuation,
+      )
+      query = response.get("query", {})
+      # the API normalizes titles (e.g. underscores to spaces); map them back
+      requested.update({n["to"]: n["from"] for n in query.get("normalized", [])})
+      for page in query.get("pages", []):
+        title = requested.get(page["title"], page["title"])
+        if page.get("missing") or page.get("invalid"):
+          missing.add(title)
+        elif page.get("revisions"):
+          texts[title] = page["revisions"][0]["slots"]["main"]["content"]
+      if "continue" not in response:
+        break
+      continuation = response["continue"]
+    pending = [title for title in titles if title not in texts and title not in missing]
+    if pending:
+      if len(pending) == len(titles):
+        raise RuntimeError(f"The API returned no content for any of {len(titles)} titles, e.g. {titles[0]!r}.")
+      texts.update(self.fetch(pending))
+      # ^pages still without revisions after the last continuation are asked for again
+    return {title: texts.get(title, "") for title in titles}
+
+  def _members(self, category_title: str) -> tuple[set[str], list[str]]:
+    """Return (page titles, subcategory titles) directly in a category."""
+    titles, subcategories = set(), []
+    for cm in self.site.pages[category_title].members():
+      if type(cm) == mwclient.page.Page:
+        # ^type() used instead of isinstance() to catch match w/ no inheritance
+        titles.add(cm.name)
+      elif isinstance(cm, mwclient.listing.Category):
+        subcategories.append(cm.name)
+    return titles, subcategories
+
+  def titles_from_category(self, category_title: str, max_depth: int, max_workers: int = 8) -> set[str]:
+    """Return the page titles in a category and its subcategories, crawling each level in parallel."""
+    titles = set()
+    seen = {category_title}
+    level = [category_title]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      for depth in range(max_depth, -1, -1):
+        next_level = []
+        for page_titles, subcategories in executor.map(self._members, level):
+          titles.update(page_titles)
+          if depth > 0:
+            next_level.extend(c for c in subcategories if c not in seen)
+            seen.update(subcategories)
+        level = next_level
+        if not level:
+          break
+    return titles
+
+
+class DirectorySource:
+  """Reads raw wikitext from a local directory with one file per page, for running offline."""
+
+  def __init__(self, path: str, suffix: str = ".wiki"):
+    self.path = path
+    self.suffix = suffix
+
+  def _file(self, title: str) -> str:
+    return os.path.join(self.path, urllib.parse.quote(title, safe="") + self.suffix)
+
+  def titles(self) -> list[str]:
+    """Return the titles of every page in the directory."""
+    return sorted(
+      urllib.parse.unquote(name[: -len(self.suffix)])
+      for name in os.listdir(self.path)
+      if name.endswith(self.suffix)
+    )
+
+  def fetch(self, titles: list[str]) -> dict[str, str]:
+    """Return {title: wikitext}, with "" for pages that have no file."""
+    texts = {}
+    for title in titles:
+      try:
+        with open(self._file(title), encoding="utf-8") as f:
+          texts[title] = f.read()
+      except FileNotFoundError:
+        texts[title] = ""
+    return texts
+
+  def save(self, texts: dict[str, str]) -> None:
+    """Write {title: wikitext} to the directory, e.g. to snapshot pages fetched from a WikiSource."""
+    os.makedirs(self.path, exist_ok=True)
+    for title, text in texts.items():
+      with open(self._file(title), "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def iter_sections(
+  titles: list[str],
+  source: WikiSource | DirectorySource,
+  max_workers: int = 4,
+  processes: int | None = None,
+  batch_size: int = MAX_TITLES_PER_QUERY,
+  sections_to_ignore: set[str] = ingest.SECTIONS_TO_IGNORE,
+) -> Iterator[tuple[list[str], str]]:
+  """Yield the (titles, text) sections of every page, as soon as each page is fetched and parsed.
+
+  Pages are fetched batch_size titles per request on max_workers threads and
+  parsed with mwparserfromhell on a pool of processes. Sections of a page stay
+  in order, but pages arrive in the order they finish. At most 2 * max_workers
+  fetches and 2 * processes parses are in flight, and more are only started as
+  results are consumed, so memory doesn't grow with the number of titles.
+  """
+  titles = list(titles)
+  starts = iter(range(0, len(titles), batch_size))
+  max_fetches = 2 * max_workers
+  max_parses = 2 * (processes or os.cpu_count() or 1)
+  fetchers = ThreadPoolExecutor(max_workers=max_workers)
+  parsers = ProcessPoolExecutor(max_workers=processes)
+  fetches, parses = set(), set()
+  pages = collections.deque()
+  # ^fetched (title, wikitext) pairs waiting for room in the parse window
+  try:
+    while True:
+      while pages and len(parses) < max_parses:
+        title, text = pages.popleft()
+        parses.add(parsers.submit(ingest.sections_from_wikitext, title, text, sections_to_ignore))
+      while len(fetches) < max_fetches and len(pages) < batch_size:
+        start = next(starts, None)
+        if start is None:
+          break
+        fetches.add(fetchers.submit(source.fetch, titles[start:start + batch_size]))
+      if not fetches and not parses:
+        break
+      done, _ = wait(fetches | parses, return_when=FIRST_COMPLETED)
+      for future in done:
+        if future in fetches:
+          fetches.remove(future)
+          pages.extend(future.result().items())
+        else:
+          parses.remove(future)
+          yield from future.result()
+      # ^finished futures are dropped here, so their wikitext and sections can be freed
+  finally:
+    fetchers.shutdown(cancel_futures=True)
+    parsers.shutdown(cancel_futures=True)